@@ -27,6 +27,8 @@
 """GL retracer generator."""
 
 
+import contextlib
+import io
 import re
 import sys
 
@@ -35,17 +37,39 @@ import specs.stdapi as stdapi
 import specs.glapi as glapi
 
 
-class GlRetracer(Retracer):
+# Function classification flags, see GlRetracer.classifyFunction
+ARRAY_POINTER = 1 << 0
+DRAW_ARRAYS = 1 << 1
+DRAW_ELEMENTS = 1 << 2
+DRAW_INDIRECT = 1 << 3
+MISC_DRAW = 1 << 4
+PACK = 1 << 5
+MAP = 1 << 6
+UNMAP = 1 << 7
+BIND_FRAMEBUFFER = 1 << 8
+GL = 1 << 9
+GET_QUERY_OBJECT = 1 << 10
+CREATE_SHADER_PROGRAM = 1 << 11
+FENCE_SYNC = 1 << 12
+COPY_IMAGE_SUB_DATA = 1 << 13
+BEGIN_TRANSFORM_FEEDBACK = 1 << 14
+
 
-    table_name = 'gl_callbacks'
+class GlRetracer(Retracer):
 
     def retraceApi(self, api):
-        # Ensure pack function have side effects
+        # Classify every function name and collect its argument names once,
+        # up front, and ensure pack functions have side effects
+        self.function_flags = {}
+        self.function_arg_names = {}
+        self.location_dependencies = {}
         abort = False
         for function in api.getAllFunctions():
+            flags = self.classifyFunction(function.name)
+            self.function_flags[function.name] = flags
+            self.function_arg_names[function.name] = frozenset(function.argNames())
             if not function.sideeffects:
-                if self.pack_function_regex.match(function.name) or \
-                   function.name.startswith('glGetQueryObject'):
+                if flags & (PACK | GET_QUERY_OBJECT):
                     sys.stderr.write('error: function %s must have sideeffects\n' % function.name)
                     abort = True
         if abort:
@@ -122,15 +146,349 @@ class GlRetracer(Retracer):
 
     unmap_function_regex = re.compile(r'^glUnmap(|Named|Object)Buffer[0-9A-Z]*$')
 
+    # All the categories above, and their flag
+    function_categories = (
+        ('draw_arrays', draw_arrays_function_regex, DRAW_ARRAYS),
+        ('draw_elements', draw_elements_function_regex, DRAW_ELEMENTS),
+        ('draw_indirect', draw_indirect_function_regex, DRAW_INDIRECT),
+        ('misc_draw', misc_draw_function_regex, MISC_DRAW),
+        ('bind_framebuffer', bind_framebuffer_function_regex, BIND_FRAMEBUFFER),
+        ('pack', pack_function_regex, PACK),
+        ('map', map_function_regex, MAP),
+        ('unmap', unmap_function_regex, UNMAP),
+    )
+
+    # The categories above, classified with a single match.  Each category is
+    # an optional lookahead, as they overlap (e.g. glDrawArraysIndirect is
+    # both a draw arrays and a draw indirect call).
+    function_category_regex = re.compile(r''.join([
+        r'(?=(?P<%s>%s))?' % (category, regex.pattern)
+        for category, regex, flag in function_categories
+    ]))
+
+    # Getter (and its arguments) used to find the pointer of the mapping
+    # destroyed by each unmap function
+    unmap_buffer_pointer_getters = {
+        'glUnmapBuffer': ('self.context.take_bound_buffer_mapping(target)', 'GetBufferPointerv', 'target, gl::BUFFER_MAP_POINTER'),
+        'glUnmapBufferARB': ('self.context.take_bound_buffer_mapping(target)', 'GetBufferPointervARB', 'target, gl::BUFFER_MAP_POINTER_ARB'),
+        'glUnmapBufferOES': ('self.context.take_bound_buffer_mapping(target)', 'GetBufferPointervOES', 'target, gl::BUFFER_MAP_POINTER_OES'),
+        'glUnmapNamedBuffer': ('self.context.take_buffer_mapping(buffer)', 'GetNamedBufferPointerv', 'buffer, gl::BUFFER_MAP_POINTER'),
+        'glUnmapNamedBufferEXT': ('self.context.take_buffer_mapping(buffer)', 'GetNamedBufferPointervEXT', 'buffer, gl::BUFFER_MAP_POINTER'),
+        # TODO
+        'glUnmapObjectBufferATI': None,
+    }
+
+    unmap_pointer_template = '\n'.join([
+        r'        let ptr = {cached}.unwrap_or_else(|| {{',
+        r'            let ptr = ptr::null_mut() as *mut c_void;',
+        r'            unsafe {{ gl::{query}({query_args}, &ptr) }};',
+        r'            ptr',
+        r'        }});',
+    ])
+
+    # Recording of the pointers returned by buffer mappings, so that the
+    # matching unmap doesn't need to query them back
+    map_pointer_tracking = {
+        'glMapBuffer': '    self.context.set_bound_buffer_mapping(target, _result);',
+        'glMapBufferARB': '    self.context.set_bound_buffer_mapping(target, _result);',
+        'glMapBufferOES': '    self.context.set_bound_buffer_mapping(target, _result);',
+        'glMapBufferRange': '    self.context.set_bound_buffer_mapping(target, _result);',
+        'glMapBufferRangeEXT': '    self.context.set_bound_buffer_mapping(target, _result);',
+        'glMapNamedBuffer': '    self.context.set_buffer_mapping(buffer, _result);',
+        'glMapNamedBufferEXT': '    self.context.set_buffer_mapping(buffer, _result);',
+        'glMapNamedBufferRange': '    self.context.set_buffer_mapping(buffer, _result);',
+        'glMapNamedBufferRangeEXT': '    self.context.set_buffer_mapping(buffer, _result);',
+    }
+
+    # Functions retraced with a fixed body (or none at all), skipping the
+    # usual argument handling and invocation
+    fixed_function_bodies = {
+        'glStringMarkerGREMEDY': None,
+        'glFrameTerminatorGREMEDY': '    region::frame_complete(call);',
+    }
+
+    # Fixed snippets shared by several functions
+
+    single_buffer_frame_complete = '\n'.join([
+        r'    if !self.double_buffer {',
+        r'        region::frame_complete(call);',
+        r'    }',
+    ])
+
+    # Query the bound pack buffer, opening the block for when there is one
+    pack_buffer_prologue = '\n'.join([
+        r'    let _pack_buffer = 0;',
+        r'    if self.context.features("pixel_buffer_object") {',
+        r'        unsafe { gl::GetIntegerv(gl::PIXEL_PACK_BUFFER_BINDING, &_pack_buffer) };',
+        r'    }',
+        r'     let buffer = Vec::<u8>::new();',
+        r'    if _pack_buffer != 0 {',
+    ])
+
+    delete_buffers_unmap = '\n'.join([
+        r'    if self.context.features("ARB_direct_state_access") {',
+        r'        for i in 0..n {',
+        r'            let buffer = buffers[i];',
+        r'            if buffer != 0 && gl::IsBuffer(buffer) {',
+        r'                let ptr = ptr::null_mut() as *mut c_void;',
+        r'                unsafe { gl::GetNamedBufferPointerv(buffers[i], gl::BUFFER_MAP_POINTER, &ptr) };',
+        r'                if ptr != ptr::null_mut() as *mut c_void {',
+        r'                    retrace::delRegionByPointer(ptr);',
+        r'                }',
+        r'            }',
+        r'        }',
+        r'    }',
+    ])
+
+    # Tracked size (if any) and size query of the buffer mapped by each whole
+    # buffer mapping function
+    map_buffer_sizes = {
+        'glMapBuffer': ('self.context.bound_buffer_size(target)', 'gl::GetBufferParameteriv(target, gl::BUFFER_SIZE, &mut length)'),
+        'glMapBufferOES': ('self.context.bound_buffer_size(target)', 'gl::GetBufferParameteriv(target, gl::BUFFER_SIZE, &mut length)'),
+        'glMapBufferARB': ('self.context.bound_buffer_size(target)', 'gl::GetBufferParameterivARB(target, gl::BUFFER_SIZE_ARB, &mut length)'),
+        'glMapNamedBuffer': ('self.context.buffer_size(buffer)', 'gl::GetNamedBufferParameteriv(buffer, gl::BUFFER_SIZE, &mut length)'),
+        'glMapNamedBufferEXT': ('self.context.buffer_size(buffer)', 'gl::GetNamedBufferParameterivEXT(buffer, gl::BUFFER_SIZE, &mut length)'),
+        'glMapObjectBufferATI': (None, 'gl::GetObjectBufferivATI(buffer, gl::OBJECT_BUFFER_SIZE_ATI, &mut length)'),
+    }
+
+    map_length_template = '\n'.join([
+        r'    let length = {cached}.unwrap_or_else(|| {{',
+        r'        let mut length = 0;',
+        r'        unsafe {{ {query} }};',
+        r'        length as GLsizeiptr',
+        r'    }});',
+    ])
+    map_length_query_template = '\n'.join([
+        r'    let mut length = 0;',
+        r'    unsafe {{ {query} }};',
+    ])
+
+    # Tracking of the buffer object state, after each call affecting it, for
+    # Context::bound_buffer_size and Context::buffer_size
+    buffer_tracking = {
+        'glBindBuffer': '    self.context.bind_buffer(target, buffer);',
+        'glBindBufferARB': '    self.context.bind_buffer(target, buffer);',
+        'glBindBufferBase': '    self.context.bind_buffer(target, buffer);',
+        'glBindBufferBaseEXT': '    self.context.bind_buffer(target, buffer);',
+        'glBindBufferBaseNV': '    self.context.bind_buffer(target, buffer);',
+        'glBindBufferRange': '    self.context.bind_buffer(target, buffer);',
+        'glBindBufferRangeEXT': '    self.context.bind_buffer(target, buffer);',
+        'glBindBufferRangeNV': '    self.context.bind_buffer(target, buffer);',
+        # Not worth tracking precisely
+        'glBindBufferOffsetEXT': '    self.context.forget_bound_buffer(target);',
+        'glBindBufferOffsetNV': '    self.context.forget_bound_buffer(target);',
+        'glBindBuffersBase': '    self.context.forget_bound_buffer(target);',
+        'glBindBuffersRange': '    self.context.forget_bound_buffer(target);',
+        # The element array buffer binding is vertex array state
+        'glBindVertexArray': '    self.context.forget_bound_buffer(gl::ELEMENT_ARRAY_BUFFER);',
+        'glBindVertexArrayAPPLE': '    self.context.forget_bound_buffer(gl::ELEMENT_ARRAY_BUFFER);',
+        'glBindVertexArrayOES': '    self.context.forget_bound_buffer(gl::ELEMENT_ARRAY_BUFFER);',
+        'glDeleteVertexArrays': '    self.context.forget_bound_buffer(gl::ELEMENT_ARRAY_BUFFER);',
+        'glDeleteVertexArraysAPPLE': '    self.context.forget_bound_buffer(gl::ELEMENT_ARRAY_BUFFER);',
+        'glDeleteVertexArraysOES': '    self.context.forget_bound_buffer(gl::ELEMENT_ARRAY_BUFFER);',
+        'glPopClientAttrib': '\n'.join([
+            '    self.context.forget_bound_buffer(gl::ARRAY_BUFFER);',
+            '    self.context.forget_bound_buffer(gl::ELEMENT_ARRAY_BUFFER);',
+        ]),
+        'glBufferData': '    self.context.set_bound_buffer_size(target, size);',
+        'glBufferDataARB': '    self.context.set_bound_buffer_size(target, size);',
+        'glBufferStorage': '    self.context.set_bound_buffer_size(target, size);',
+        'glBufferStorageEXT': '    self.context.set_bound_buffer_size(target, size);',
+        'glNamedBufferData': '    self.context.set_buffer_size(buffer, size);',
+        'glNamedBufferDataEXT': '    self.context.set_buffer_size(buffer, size);',
+        'glNamedBufferStorage': '    self.context.set_buffer_size(buffer, size);',
+        'glNamedBufferStorageEXT': '    self.context.set_buffer_size(buffer, size);',
+        'glDeleteBuffers': '\n'.join([
+            '    for i in 0..n {',
+            '        self.context.delete_buffer(buffers[i]);',
+            '    }',
+        ]),
+        'glDeleteBuffersARB': '\n'.join([
+            '    for i in 0..n {',
+            '        self.context.delete_buffer(buffers[i]);',
+            '    }',
+        ]),
+    }
+
+    # Conditions under which state setting calls are redundant with the
+    # tracked state, and can be skipped
+    redundant_state_checks = {
+        'glBindBuffer': 'self.context.bound_buffer(target) == Some(buffer)',
+        'glBindBufferARB': 'self.context.bound_buffer(target) == Some(buffer)',
+        'glActiveTexture': '!self.context.inside_list && self.context.active_texture == texture',
+        'glActiveTextureARB': '!self.context.inside_list && self.context.active_texture == texture',
+    }
+
+    # Types of the output arguments of pack functions
+    pack_output_types = (stdapi.Pointer, stdapi.Array, stdapi.Blob, stdapi.Opaque)
+
+    # Sizing of the read back buffer of pack functions, when a pack buffer is
+    # bound, and the parameter receiving the read back data
+    pack_buffer_readbacks = {
+        # TODO: https://github.com/apitrace/apitrace/commit/2a83ddd4f67014e2aacf99c6b203fd3f6b13c4f3#r130319306
+        'glGetTexImage': ('pixels', r'        return;'),
+        'glGetTexnImage': ('pixels', r'     buffer.resize(call.arg(4).to_u32().unwrap(), 0);'),
+        'glGetTextureImage': ('pixels', r'     buffer.resize(call.arg(4).to_u32().unwrap(), 0);'),
+        'glReadPixels': ('pixels', '\n'.join([
+            r'     let _w = call.arg(2).to_i32().unwrap();',
+            r'     let _h = call.arg(3).to_i32().unwrap();',
+            r'     buffer.resize(_w * _h * 64, 0);',
+        ])),
+        'glReadnPixels': ('data', r'     buffer.resize(call.arg(6).to_i32().unwrap(), 0);'),
+    }
+
+    # Snippets surrounding the invocation of glGetQueryObject*
+    get_query_object_prologue = '\n'.join([
+        # The query buffer binding is tracked along the other buffer bindings
+        r'    let _query_buffer = self.context.bound_buffer(gl::QUERY_BUFFER).unwrap_or(0);',
+        r'    if (_query_buffer == 0 && retrace::queryHandling == retrace::QUERY_SKIP) {',
+        r'        return;',
+        r'    }',
+        r"'wait_for_query_result: loop {",
+    ])
+
+    get_query_object_epilogue = '\n'.join([
+        r'    if _query_buffer == 0 && queryHandling != QUERY_SKIP {',
+        r'        let query_result = call.arg(2).to_array().unwrap();',
+        #r'        assert(query_result && query_result->values.size() == 1);',
+        r'        let expect = query_result.values[0].to_u32().unwrap();',
+        r'        if call.arg(1).to_u32().unwrap() == gl::QUERY_RESULT_AVAILABLE {',
+        r'            if expect == 1 && retval == 0 {',
+        r"                continue 'wait_for_query_result;",
+        r'        }} else if queryHandling == QUERY_RUN_AND_CHECK_RESULT {',
+        r'            let diff = (expect as i64 - retval as i64).abs(); ',
+        r'            if diff > 0 as i64 {',
+        r'                println!("Warning: query returned {}  but trace contained {} (tol = {})", retval, expect, retrace::queryTolerance);',
+        r'            }',
+        r'        }',
+        r"    break 'wait_for_query_result;",
+        r'    }',
+        r'}',
+    ])
+
+    # Output of glGetQueryObject*, written to the query buffer when one is
+    # bound, or to a local to be checked against the trace otherwise
+    query_object_output_template = '\n'.join([
+        r'    let retval: {basetype} = 0;',
+        r'    if _query_buffer != 0 {{',
+        r'        {lvalue} = ({rvalue}).to_pointer();',
+        r'    }} else {{',
+        r'        {lvalue} = retval }};',
+    ])
+
+    # Inference of the drawable size, per function
+    update_drawable_snippets = {
+        'glViewport': '    glretrace::updateDrawable(x + width, y + height);',
+        # We are concerned about drawables so only care for the first viewport
+        'glViewportArrayv': '\n'.join([
+            '    if first == 0 && count > 0 {',
+            '        let x = v[0];\nlet y = v[1];\nlet w = v[2];\nlet h = v[3];',
+            '        glretrace::updateDrawable(x + w, y + h);',
+            '    }',
+        ]),
+        'glViewportIndexedf': '\n'.join([
+            '    if index == 0 {',
+            '        glretrace::updateDrawable(x + w, y + h);',
+            '    }',
+        ]),
+        'glViewportIndexedfv': '\n'.join([
+            '    if index == 0 {',
+            '        let x = v[0];\nlet y = v[1];\nlet w = v[2];\nlet h = v[3];',
+            '        glretrace::updateDrawable(x + w, y + h);',
+            '    }',
+        ]),
+        # Some applications do all their rendering in a framebuffer, and
+        # then just blit to the drawable without ever calling glViewport.
+        'glBlitFramebuffer': '    glretrace::updateDrawable(std::max(dstX0, dstX1), std::max(dstY0, dstY1));',
+        'glBlitFramebufferEXT': '    glretrace::updateDrawable(std::max(dstX0, dstX1), std::max(dstY0, dstY1));',
+    }
+
+    # Check of the compile/link status of a shader/program object, followed
+    # by the retrieval of its info log
+    status_check_template = '\n'.join([
+        r'        let {status} = 0;',
+        r'        unsafe {{ gl::{getter}({object}, gl::{status_enum}, &{status}) }};',
+        r'        if {status} == 0 {{',
+        r'             status_check_failed("{message}");',
+        r'        }}',
+        r'        let info_log_length = 0;',
+        r'        unsafe {{ gl::{getter}({object}, gl::{info_log_length_enum}, &info_log_length) }};',
+        r'        if info_log_length > 1 {{',
+        r'             let infoLog = vec![0i8; info_log_length].as_mut_ptr();',
+        r'             unsafe {{ gl::{info_log}({object}, info_log_length, std::ptr::null_mut(), infoLog) }};',
+        r'        }}',
+    ])
+
+    shader_compile_check = dict(
+        status='compile_status', message='compilation failed',
+        getter='GetShaderiv', object='shader', status_enum='COMPILE_STATUS',
+        info_log_length_enum='INFO_LOG_LENGTH', info_log='GetShaderInfoLog',
+    )
+    program_link_check = dict(
+        status='link_status', message='link failed',
+        getter='GetProgramiv', object='program', status_enum='LINK_STATUS',
+        info_log_length_enum='INFO_LOG_LENGTH', info_log='GetProgramInfoLog',
+    )
+
+    # Status check emitted after each shader compilation/program link
+    status_checks = {
+        'glCompileShader': shader_compile_check,
+        'glCompileShaderARB': dict(shader_compile_check,
+            getter='GetObjectParameterivARB', object='shaderObj', status_enum='OBJECT_COMPILE_STATUS_ARB',
+            info_log_length_enum='OBJECT_INFO_LOG_LENGTH_ARB', info_log='GetInfoLogARB',
+        ),
+        'glLinkProgram': program_link_check,
+        'glLinkProgramARB': dict(program_link_check,
+            getter='GetObjectParameterivARB', object='programObj', status_enum='OBJECT_LINK_STATUS_ARB',
+            info_log_length_enum='OBJECT_INFO_LOG_LENGTH_ARB', info_log='GetInfoLogARB',
+        ),
+        'glCreateShaderProgramv': program_link_check,
+        'glCreateShaderProgramEXT': program_link_check,
+        'glCreateShaderProgramvEXT': program_link_check,
+        'glProgramBinary': program_link_check,
+        'glProgramBinaryOES': program_link_check,
+    }
+
+    # Function name prefixes, and the flag they classify functions with
+    function_prefix_flags = (
+        ('gl', GL),
+        ('glGetQueryObject', GET_QUERY_OBJECT),
+        ('glCreateShaderProgram', CREATE_SHADER_PROGRAM),
+        ('glFenceSync', FENCE_SYNC),
+        ('glCopyImageSubData', COPY_IMAGE_SUB_DATA),
+        ('glBeginTransformFeedback', BEGIN_TRANSFORM_FEEDBACK),
+    )
+
+    def classifyFunction(self, name):
+        '''Return the classification flags of the named function.'''
+
+        flags = 0
+        if name in self.array_pointer_function_names:
+            flags |= ARRAY_POINTER
+        categories = self.function_category_regex.match(name)
+        for category, regex, flag in self.function_categories:
+            if categories.group(category) is not None:
+                flags |= flag
+        for prefix, flag in self.function_prefix_flags:
+            if name.startswith(prefix):
+                flags |= flag
+        return flags
+
     def retraceFunctionBody(self, function):
-        is_array_pointer = function.name in self.array_pointer_function_names
-        is_draw_arrays = self.draw_arrays_function_regex.match(function.name) is not None
-        is_draw_elements = self.draw_elements_function_regex.match(function.name) is not None
-        is_draw_indirect = self.draw_indirect_function_regex.match(function.name) is not None
-        is_misc_draw = self.misc_draw_function_regex.match(function.name)
+        name = function.name
+        if name in self.fixed_function_bodies:
+            body = self.fixed_function_bodies[name]
+            if body is not None:
+                print(body)
+            return
+
+        flags = self.function_flags[name]
+        is_draw_arrays = flags & DRAW_ARRAYS
+        is_draw_elements = flags & DRAW_ELEMENTS
+        is_misc_draw = flags & MISC_DRAW
 
         #NOTE: Assuming irrelevance
-        if function.name.startswith('gl') and not function.name.startswith('glX') and False:
+        #if name.startswith('gl') and not name.startswith('glX'):
             # The Windows OpenGL runtime will skip calls when there's no
             # context bound to the current context, but this might cause
             # crashes on other systems, particularly with NVIDIA Linux drivers.
@@ -143,54 +501,37 @@ class GlRetracer(Retracer):
             #print(r'        return;')
             #print(r'#endif')
             #print(r'    }')
-
-            
-            print(r'    if (retrace::markers) {')
-            print(r'        glretrace::insertCallMarker(call, self.context);')
-            print(r'    }')
+            #print(r'    if (retrace::markers) {')
+            #print(r'        glretrace::insertCallMarker(call, self.context);')
+            #print(r'    }')
 
         # For backwards compatibility with old traces where non VBO drawing was supported
         #NOTE: Working with current traces ONLY
-        if (is_array_pointer or is_draw_arrays or is_draw_elements) and not is_draw_indirect and False:
-            print('    if (retrace::parser->getVersion() < 1) {')
-
-            if is_array_pointer or is_draw_arrays:
-                print('        GLint _array_buffer = 0;')
-                print('        glGetIntegerv(GL_ARRAY_BUFFER_BINDING, &_array_buffer);')
-                print('        if (!_array_buffer) {')
-                #self.failFunction(function)
-                print('        }')
-
-            if is_draw_elements:
-                print('        GLint _element_array_buffer = 0;')
-                print('        glGetIntegerv(GL_ELEMENT_ARRAY_BUFFER_BINDING, &_element_array_buffer);')
-                print('        if (!_element_array_buffer) {')
-                #self.failFunction(function)
-                print('        }')
-            
-            print('    }')
+        #if (is_array_pointer or is_draw_arrays or is_draw_elements) and not is_draw_indirect:
+        #    print('    if (retrace::parser->getVersion() < 1) {')
+        #    if is_array_pointer or is_draw_arrays:
+        #        print('        GLint _array_buffer = 0;')
+        #        print('        glGetIntegerv(GL_ARRAY_BUFFER_BINDING, &_array_buffer);')
+        #        print('        if (!_array_buffer) {')
+        #        self.failFunction(function)
+        #        print('        }')
+        #    if is_draw_elements:
+        #        print('        GLint _element_array_buffer = 0;')
+        #        print('        glGetIntegerv(GL_ELEMENT_ARRAY_BUFFER_BINDING, &_element_array_buffer);')
+        #        print('        if (!_element_array_buffer) {')
+        #        self.failFunction(function)
+        #        print('        }')
+        #    print('    }')
 
         # When no query buffer object is bound, and we don't request that glGetQueryObject
         # is run than glGetQueryObject is a no-op.
-        if function.name.startswith('glGetQueryObject'):
-            print(r'    let _query_buffer = 0;')
-            print(r'    if self.context.features("query_buffer_object") {')
-            print(r'        unsafe { gl::GetIntegerv(gl::QUERY_BUFFER_BINDING, &_query_buffer) };')
-            print(r'    }')
-            print(r'    if (_query_buffer == 0 && retrace::queryHandling == retrace::QUERY_SKIP) {')
-            print(r'        return;')
-            print(r'    }')
-            print('\'wait_for_query_result: loop {')
+        if flags & GET_QUERY_OBJECT:
+            print(self.get_query_object_prologue)
 
         # Pre-snapshots
-        if self.bind_framebuffer_function_regex.match(function.name):
+        if flags & BIND_FRAMEBUFFER:
             pass
             #print('    assert(call.flags & trace::CALL_FLAG_SWAP_RENDERTARGET);')
-        if function.name == 'glStringMarkerGREMEDY':
-            return
-        if function.name == 'glFrameTerminatorGREMEDY':
-            print('    region::frame_complete(call);')
-            return
 
         Retracer.retraceFunctionBody(self, function)
 
@@ -199,136 +540,80 @@ class GlRetracer(Retracer):
         # execution if the query buffer is used or for the check to make sense, and if we
         # just want to execute the query for timing purpouses we also should wait
         # for the result.
-        if function.name.startswith('glGetQueryObject'):
-           print(r'    if _query_buffer == 0 && queryHandling != QUERY_SKIP {')
-           print(r'        let query_result = call.arg(2).to_array().unwrap();')
-           #print(r'        assert(query_result && query_result->values.size() == 1);')
-           print(r'        let expect = query_result.values[0].to_u32().unwrap();')
-           print(r'        if call.arg(1).to_u32().unwrap() == gl::QUERY_RESULT_AVAILABLE {')
-           print(r'            if expect == 1 && retval == 0 {')
-           print('                continue \'wait_for_query_result;')
-           print(r'        }} else if queryHandling == QUERY_RUN_AND_CHECK_RESULT {')
-           print(r'            let diff = (expect as i64 - retval as i64).abs(); ')
-           print(r'            if diff > 0 as i64 {')
-           print(r'                println!("Warning: query returned {}  but trace contained {} (tol = {})", retval, expect, retrace::queryTolerance);')
-           print(r'            }')
-           print(r'        }')
-           print('    break \'wait_for_query_result;')
-           print(r'    }')
-           print(r'}')
+        if flags & GET_QUERY_OBJECT:
+            print(self.get_query_object_epilogue)
 
 
         # Post-snapshots
-        if function.name in ('glFlush', 'glFinish'):
-            print('    if !self.double_buffer {')
-            print('        region::frame_complete(call);')
-            print('    }')
+        if name in {'glFlush', 'glFinish'}:
+            print(self.single_buffer_frame_complete)
         if is_draw_arrays or is_draw_elements or is_misc_draw:
             pass
             # print('    assert(call.flags & trace::CALL_FLAG_RENDER);')
 
     def overrideArgs(self, function):
-        if not self.pack_function_regex.match(function.name):
+        if not self.function_flags[function.name] & PACK:
             return
 
-        print(r'    let _pack_buffer = 0;')
-        print(r'    if self.context.features("pixel_buffer_object") {')
-        print(r'        unsafe { gl::GetIntegerv(gl::PIXEL_PACK_BUFFER_BINDING, &_pack_buffer) };')
-        print(r'    }')
-        print(r'     let buffer = Vec::<u8>::new();')
-        print(r'    if _pack_buffer != 0 {')
+        print(self.pack_buffer_prologue)
         # if no pack buffer is bound we have to read back
-        data_param_name = "pixels"
-        if function.name == "glGetTexImage":
-            # TODO: https://github.com/apitrace/apitrace/commit/2a83ddd4f67014e2aacf99c6b203fd3f6b13c4f3#r130319306
-            print(r'        return;')
-        elif function.name == "glGetTexnImage":
-            print(r'     buffer.resize(call.arg(4).to_u32().unwrap(), 0);');
-        elif function.name == "glGetTextureImage":
-            print(r'     buffer.resize(call.arg(4).to_u32().unwrap(), 0);');
-        elif function.name == "glReadPixels":
-            print(r'     let _w = call.arg(2).to_i32().unwrap();')
-            print(r'     let _h = call.arg(3).to_i32().unwrap();')
-            print(r'     buffer.resize(_w * _h * 64, 0);')
-        elif function.name == "glReadnPixels":
-            print(r'     buffer.resize(call.arg(6).to_i32().unwrap(), 0);')
-            data_param_name = "data"
-        else:
+        readback = self.pack_buffer_readbacks.get(function.name)
+        if readback is None:
             print(r'    return;')
             print(r'    }')
             return
-
+        data_param_name, snippet = readback
+        print(snippet)
         print(r'    }')
         print('    {} = buffer.data();'.format(data_param_name))
 
 
     def invokeFunction(self, function):
-        if function.name == "glGetActiveUniformBlockName":
+        name = function.name
+        flags = self.function_flags[name]
+
+        if name == "glGetActiveUniformBlockName":
             print('    let name_buf = vec![GLchar ;bufSize];')
             print('    uniformBlockName = name_buf.data();')
             print('    let traced_name = (call.arg(4)).to_string().unwrap();')
             print('    glretrace::mapUniformBlockName(program, (call.arg(1)).to_i32().unwrap(), traced_name, _uniformBlock_map);')
-        if function.name == "glGetProgramResourceName":
+        if name == "glGetProgramResourceName":
             print('    let name_buf = vec![GLchar ;bufSize];')
             print('    name = name_buf.data();')
             print('    let traced_name = (call.arg(5)).to_string().unwrap();')
             print('    glretrace::trackResourceName(program, programInterface, index, traced_name);')
-        if function.name == "glGetProgramResourceiv":
+        if name == "glGetProgramResourceiv":
             print('    glretrace::mapResourceLocation(program, programInterface, index, call.arg(4).to_array().unwrap(), call.arg(7).to_array().unwrap(), _location_map);')
         # Infer the drawable size from GL calls
-        if function.name == "glViewport":
-            print('    glretrace::updateDrawable(x + width, y + height);')
-        if function.name == "glViewportArrayv":
-            # We are concerned about drawables so only care for the first viewport
-            print('    if first == 0 && count > 0 {')
-            print('        let x = v[0];\nlet y = v[1];\nlet w = v[2];\nlet h = v[3];')
-            print('        glretrace::updateDrawable(x + w, y + h);')
-            print('    }')
-        if function.name == "glViewportIndexedf":
-            print('    if index == 0 {')
-            print('        glretrace::updateDrawable(x + w, y + h);')
-            print('    }')
-        if function.name == "glViewportIndexedfv":
-            print('    if index == 0 {')
-            print('        let x = v[0];\nlet y = v[1];\nlet w = v[2];\nlet h = v[3];')
-            print('        glretrace::updateDrawable(x + w, y + h);')
-            print('    }')
-        if function.name in ('glBlitFramebuffer', 'glBlitFramebufferEXT'):
-            # Some applications do all their rendering in a framebuffer, and
-            # then just blit to the drawable without ever calling glViewport.
-            print('    glretrace::updateDrawable(std::max(dstX0, dstX1), std::max(dstY0, dstY1));')
-
-        if function.name == "glEnd":
+        update_drawable = self.update_drawable_snippets.get(name)
+        if update_drawable is not None:
+            print(update_drawable)
+
+        if name == "glEnd":
             #print(r'    if (self.context) {')
-            print(r'    self.context.insideBeginEnd = false;')
+            print(r'    self.context.inside_begin_end = false;')
             #print(r'    }')
 
-        if function.name == 'memcpy':
+        if name == 'memcpy':
             print('    if (!dest || !src || !n) return;')
 
         # Skip glEnable/Disable(GL_DEBUG_OUTPUT_SYNCHRONOUS) as we don't
         # faithfully set the CONTEXT_DEBUG_BIT_ARB flags on context creation.
-        if function.name in ('glEnable', 'glDisable'):
+        if name in {'glEnable', 'glDisable'}:
             print('    if cap == gl::DEBUG_OUTPUT_SYNCHRONOUS {return };;')
 
+        is_map = flags & MAP
+        is_unmap = flags & UNMAP
+
         # Destroy the buffer mapping
-        if self.unmap_function_regex.match(function.name):
-            print(r'        let ptr = ptr::null_mut() as *mut c_void;')
-            if function.name == 'glUnmapBuffer':
-                print(r'            unsafe { gl::GetBufferPointerv(target, gl::BUFFER_MAP_POINTER, &ptr) };')
-            elif function.name == 'glUnmapBufferARB':
-                print(r'            unsafe { gl::GetBufferPointervARB(target, gl::BUFFER_MAP_POINTER_ARB, &ptr) };')
-            elif function.name == 'glUnmapBufferOES':
-                print(r'            unsafe { gl::GetBufferPointervOES(target, gl::BUFFER_MAP_POINTER_OES, &ptr) };')
-            elif function.name == 'glUnmapNamedBuffer':
-                print(r'            unsafe { gl::GetNamedBufferPointerv(buffer, gl::BUFFER_MAP_POINTER, &ptr) };')
-            elif function.name == 'glUnmapNamedBufferEXT':
-                print(r'            unsafe { gl::GetNamedBufferPointervEXT(buffer, gl::BUFFER_MAP_POINTER, &ptr) };')
-            elif function.name == 'glUnmapObjectBufferATI':
-                # TODO
-                pass
+        if is_unmap:
+            getter = self.unmap_buffer_pointer_getters[name]
+            if getter is None:
+                print(r'        let ptr = ptr::null_mut() as *mut c_void;')
             else:
-                assert False
+                # Prefer the pointer recorded when mapping
+                cached, query, query_args = getter
+                print(self.unmap_pointer_template.format(cached=cached, query=query, query_args=query_args))
             print(r'        if (ptr) {')
             print(r'            retrace::delRegionByPointer(ptr);')
             print(r'        } else {')
@@ -338,73 +623,61 @@ class GlRetracer(Retracer):
         # Implicit destruction of buffer mappings
         # TODO: handle BufferData variants
         # TODO: don't rely on GL_ARB_direct_state_access
-        if function.name in ('glDeleteBuffers', 'glDeleteBuffersARB'):
-            print(r'    if self.context.features("ARB_direct_state_access") {')
-            print(r'        for i in 0..n {')
-            print(r'            let buffer = buffers[i];')
-            print(r'            if buffer != 0 && gl::IsBuffer(buffer) {')
-            print(r'                let ptr = ptr::null_mut() as *mut c_void;')
-            print(r'                unsafe { gl::GetNamedBufferPointerv(buffers[i], gl::BUFFER_MAP_POINTER, &ptr) };')
-            print(r'                if ptr != ptr::null_mut() as *mut c_void {')
-            print(r'                    retrace::delRegionByPointer(ptr);')
-            print(r'                }')
-            print(r'            }')
-            print(r'        }')
-            print(r'    }')
+        if name in {'glDeleteBuffers', 'glDeleteBuffersARB'}:
+            print(self.delete_buffers_unmap)
 
-        if function.name.startswith('glCopyImageSubData'):
+        if flags & COPY_IMAGE_SUB_DATA:
             #print(r'    if (srcTarget == GL_RENDERBUFFER || dstTarget == GL_RENDERBUFFER) {')
             #print(r'        retrace::warning(call) << " renderbuffer targets unsupported (https://git.io/JOMRC)\n";')
             #print(r'    }')
             pass
 
-        is_draw_arrays = self.draw_arrays_function_regex.match(function.name) is not None
-        is_draw_elements = self.draw_elements_function_regex.match(function.name) is not None
-        is_misc_draw = self.misc_draw_function_regex.match(function.name) is not None
+        is_draw_arrays = flags & DRAW_ARRAYS
+        is_draw_elements = flags & DRAW_ELEMENTS
 
-        profileDraw = (
-            is_draw_arrays or
-            is_draw_elements or
-            is_misc_draw or
-            function.name == 'glBegin' or
-            function.name.startswith('glDispatchCompute')
-        )
+        #profileDraw = (
+        #    is_draw_arrays or
+        #    is_draw_elements or
+        #    is_misc_draw or
+        #    name == 'glBegin' or
+        #    name.startswith('glDispatchCompute')
+        #)
 
         # Only profile if not inside a list as the queries get inserted into list
-        if function.name == 'glNewList':
+        if name == 'glNewList':
             #print(r'    if (self.context) {')
-            print(r'    self.context.insideList = true;')
+            print(r'    self.context.inside_list = true;')
             #print(r'    }')
 
-        if function.name == 'glEndList':
+        if name == 'glEndList':
             #print(r'    if (self.context) {')
-            print(r'    self.context.insideList = false;')
+            print(r'    self.context.inside_list = false;')
             #print(r'    }')
 
-        if function.name == 'glBegin' or \
+        if name == 'glBegin' or \
            is_draw_arrays or \
            is_draw_elements or \
-           function.name.startswith('glBeginTransformFeedback'):
+           flags & BEGIN_TRANSFORM_FEEDBACK:
             #print(r'    if (retrace::debug > 0) {')
             #print(r'        _validateActiveProgram(call);')
             #print(r'    }')
             pass
 
-        if function.name != 'glEnd' and False:
-            print(r'    if (self.context && !self.context->insideList && !self.context->insideBeginEnd && retrace::profiling) {')
-            if profileDraw:
-                print(r'        glretrace::beginProfile(call, true);')
-            else:
-                print(r'        glretrace::beginProfile(call, false);')
-            print(r'    }')
+        #if name != 'glEnd':
+        #    print(r'    if (self.context && !self.context->insideList && !self.context->insideBeginEnd && retrace::profiling) {')
+        #    if profileDraw:
+        #        print(r'        glretrace::beginProfile(call, true);')
+        #    else:
+        #        print(r'        glretrace::beginProfile(call, false);')
+        #    print(r'    }')
 
-        if function.name in ('glCreateShaderProgramv', 'glCreateShaderProgramEXT', 'glCreateShaderProgramvEXT'):
+        if name in {'glCreateShaderProgramv', 'glCreateShaderProgramEXT', 'glCreateShaderProgramvEXT'}:
             # When dumping state, break down glCreateShaderProgram* so that the
             # shader source can be recovered.
             #print(r'    if (retrace::dumpingState) {')
             #print(r'        GLuint _shader = glCreateShader(type);')
             #print(r'        if (_shader) {')
-            if not function.name.startswith('glCreateShaderProgramv'):
+            if name == 'glCreateShaderProgramEXT':
             #    print(r'            let count = 1;')
             #    print(r'            const GLchar **strings = &string;')
                 pass
@@ -414,7 +687,7 @@ class GlRetracer(Retracer):
             #print(r'            if (_program) {')
             #print(r'                let compiled = false;')
             #print(r'                unsafe { gl::GetShaderiv(_shader, gl::COMPILE_STATUS, &compiled) };')
-            #if function.name == 'glCreateShaderProgramvEXT':
+            #if name == 'glCreateShaderProgramvEXT':
             #    print(r'                unsafe { gl::ProgramParameteriEXT(_program, gl::PROGRAM_SEPARABLE, GL_TRUE) };')
             #else:
             #    print(r'                unsafe { gl::ProgramParameteri(_program, gl::PROGRAM_SEPARABLE, GL_TRUE) };')
@@ -433,14 +706,14 @@ class GlRetracer(Retracer):
             #print(r'    } else {')
             Retracer.invokeFunction(self, function)
             #print(r'    }')
-        elif function.name in ('glDetachShader', 'glDetachObjectARB'):
+        elif name in {'glDetachShader', 'glDetachObjectARB'}:
             #print(r'    if (!retrace::dumpingState) {')
             Retracer.invokeFunction(self, function)
             #print(r'    }')
-        elif function.name == 'glClientWaitSync':
+        elif name == 'glClientWaitSync':
             print(r'    _result = region::client_wait_sync(call, sync, flags, timeout);')
             print()
-        elif function.name == 'glGetSynciv':
+        elif name == 'glGetSynciv':
             print(r'    if pname == gl::SYNC_STATUS &&')
             print(r'        bufSize >= 1 &&')
             print(r'        values != NULL &&')
@@ -448,41 +721,60 @@ class GlRetracer(Retracer):
             print(r'        // Fence was signalled, so ensure it happened here')
             print(r'        region::block_on_fence(call, sync, gl::SYNC_FLUSH_COMMANDS_BIT);')
             print(r'    }')
+        elif name in self.redundant_state_checks:
+            print(r'    if !(%s) {' % self.redundant_state_checks[name])
+            Retracer.invokeFunction(self, function)
+            print(r'    }')
         else:
             Retracer.invokeFunction(self, function)
 
-        # Keep track of current program/pipeline.  Using glGet as opposed to
-        # the call parameter ensures the cached value stays consistent despite
-        # GL errors.  See also https://github.com/apitrace/apitrace/issues/679
-        if function.name in ('glUseProgram'):
-            #print(r'    if (self.context) {')
-            print(r'        self.context.currentUserProgram = call.arg(0).to_u32().unwrap();')
-            print(r'        self.context.currentProgram = _glGetInteger(GL_CURRENT_PROGRAM);')
-            #print(r'    }')
-        if function.name in ('glUseProgramObjectARB',):
-            #print(r'    if (self.context) {')
-            print(r'        self.context.currentUserProgram = call.arg(0).to_u32().unwrap();')
-            print(r'        self.context.currentProgram = glGetHandleARB(GL_PROGRAM_OBJECT_ARB);')
-            #print(r'    }')
-        if function.name in ('glBindProgramPipeline', 'glBindProgramPipelineEXT'):
-            print(r'    if (self.context) {')
-            print(r'        self.context.currentPipeline = pipeline;')
+        # Keep track of buffer bindings and sizes
+        buffer_tracking = self.buffer_tracking.get(name)
+        if buffer_tracking is not None:
+            print(buffer_tracking)
+
+        # Keep track of current program/pipeline, so that uniform calls
+        # don't need to query it back.  This trusts the call to succeed, see
+        # also https://github.com/apitrace/apitrace/issues/679
+        # glUseProgram is compiled into display lists, so the program is
+        # left alone while compiling one, and forgotten whenever one may
+        # have changed it
+        if name == 'glUseProgram':
+            print(r'    if !self.context.inside_list {')
+            print(r'        self.context.current_user_program = call.arg(0).to_u32().unwrap();')
+            print(r'        self.context.current_program = Some(program);')
+            print(r'    }')
+        if name == 'glUseProgramObjectARB':
+            print(r'    if !self.context.inside_list {')
+            print(r'        self.context.current_user_program = call.arg(0).to_u32().unwrap();')
+            print(r'        self.context.current_program = Some(programObj);')
             print(r'    }')
+        if name in {'glNewList', 'glEndList', 'glCallList', 'glCallLists'}:
+            print(r'    self.context.current_program = None;')
+        if name in {'glBindProgramPipeline', 'glBindProgramPipelineEXT'}:
+            print(r'    self.context.current_pipeline = pipeline;')
+
+        # Keep track of the active texture unit, forgetting it whenever
+        # display lists or the attribute stack may have changed it
+        if name in {'glActiveTexture', 'glActiveTextureARB'}:
+            print(r'    self.context.active_texture = texture;')
+        if name in {'glNewList', 'glEndList', 'glCallList', 'glCallLists', 'glPopAttrib'}:
+            print(r'    self.context.active_texture = 0;')
 
         # Ensure this context flushes before switching to another thread to
         # prevent deadlock.
         # TODO: Defer flushing until another thread actually invokes
         # ClientWaitSync.
-        if function.name.startswith("glFenceSync"):
+        if flags & FENCE_SYNC:
             #print('    if (self.context) {')
             print('    self.context.needs_flush = true;')
             #print('    }')
-        if function.name in ("glFlush", "glFinish"):
+        if name in ("glFlush", "glFinish"):
             #print('    if (self.context) {')
             print('    self.context.needs_flush = false;')
             #print('    }')
 
-        if function.name == "glBegin":
+        if name == "glBegin":
             #print('    if (self.context) {')
             print('    self.context.inside_begin_end = true;')
             #print('    }')
@@ -495,92 +787,39 @@ class GlRetracer(Retracer):
         #print(r'    }')
 
         # Error checking
-        if function.name.startswith('gl'):
+        if flags & GL:
             # glGetError is not allowed inside glBegin/glEnd
             #TODO: handle debug
             #print('    if (retrace::debug > 0 && self.context && !self.context->insideBeginEnd) {')
             #print('        glretrace::checkGlError(call);')
-            if function.name in ('glProgramStringARB', 'glLoadProgramNV'):
+            if name in {'glProgramStringARB', 'glLoadProgramNV'}:
                 print(r'        let error_position: GLint = -1;')
                 print(r'        unsafe { gl::GetIntegerv(gl::PIXEL_PACK_BUFFER_BINDING, &error_position) };')
                 print(r'        if error_position != -1 {')
                 print(r'            let error_string = unsafe { gl::GetString(gl::PROGRAM_ERROR_STRING_ARB) };')
                 print(r'            println!("error in position {}: {}", error_position, error_string);')
                 print(r'        }')
-            if function.name == 'glCompileShader':
-                print(r'        let compile_status = 0;')
-                print(r'        unsafe { gl::GetShaderiv(shader, gl::COMPILE_STATUS, &compile_status) };')
-                print(r'        if compile_status == 0 {')
-                print(r'             println!("compilation failed");')
-                print(r'        }')
-                print(r'        let info_log_length = 0;')
-                print(r'        unsafe { gl::GetShaderiv(shader, gl::INFO_LOG_LENGTH, &info_log_length) };')
-                print(r'        if info_log_length > 1 {')
-                print(r'             let infoLog = vec![0i8; info_log_length].as_mut_ptr();')
-                print(r'             unsafe { gl::GetShaderInfoLog(shader, info_log_length, std::ptr::null_mut(), infoLog) };')
-                #print(r'             retrace::warning(call) << infoLog << "\n";')
-                #print(r'             delete [] infoLog;')
-                print(r'        }')
-            if function.name in ('glLinkProgram', 'glCreateShaderProgramv', 'glCreateShaderProgramEXT', 'glCreateShaderProgramvEXT', 'glProgramBinary', 'glProgramBinaryOES'):
-                if function.name.startswith('glCreateShaderProgram'):
-                    print(r'        let program = _result;')
-                print(r'        let link_status = 0;')
-                print(r'        unsafe { gl::GetProgramiv(program, gl::LINK_STATUS, &link_status) };')
-                print(r'        if link_status == 0 {')
-                print(r'             println!("link failed");')
-                print(r'        }')
-                print(r'        let info_log_length = 0;')
-                print(r'        unsafe { gl::GetProgramiv(program, gl::INFO_LOG_LENGTH, &info_log_length) };')
-                print(r'        if info_log_length > 1 {')
-                print(r'             let infoLog = vec![0i8; info_log_length].as_mut_ptr();')
-                print(r'             unsafe { gl::GetProgramInfoLog(program, info_log_length, std::ptr::null_mut(), infoLog) };')
-                #print(r'             retrace::warning(call) << infoLog << "\n";')
-                #print(r'             delete [] infoLog;')
-                print(r'        }')
-            if function.name == 'glCompileShaderARB':
-                print(r'        let compile_status = 0;')
-                print(r'        unsafe { gl::GetObjectParameterivARB(shaderObj, gl::OBJECT_COMPILE_STATUS_ARB, &compile_status) };')
-                print(r'        if (!compile_status) {')
-                print(r'             retrace::warning(call) << "compilation failed\n";')
-                print(r'        }')
-                print(r'        let info_log_length = 0;')
-                print(r'        unsafe { gl::GetObjectParameterivARB(shaderObj, gl::OBJECT_INFO_LOG_LENGTH_ARB, &info_log_length) };')
-                print(r'        if info_log_length > 1 {')
-                print(r'             let infoLog = vec![0i8; info_log_length].as_mut_ptr();')
-                print(r'             unsafe { gl::GetInfoLogARB(shaderObj, info_log_length, std::ptr::null_mut(), infoLog) };')
-                #print(r'             retrace::warning(call) << infoLog << "\n";')
-                #print(r'             delete [] infoLog;')
-                print(r'        }')
-            if function.name == 'glLinkProgramARB':
-                print(r'        let link_status = 0;')
-                print(r'        unsafe { gl::GetObjectParameterivARB(programObj, gl::OBJECT_LINK_STATUS_ARB, &link_status) };')
-                print(r'        if link_status == 0 {')
-                print(r'             println!("link failed");')
-                print(r'        }')
-                print(r'        let info_log_length = 0;')
-                print(r'        unsafe { gl::GetObjectParameterivARB(programObj, gl::OBJECT_INFO_LOG_LENGTH_ARB, &info_log_length) };')
-                print(r'        if info_log_length > 1 {')
-                print(r'             let infoLog = vec![0i8; info_log_length].as_mut_ptr();')
-                print(r'             unsafe { gl::GetInfoLogARB(programObj, info_log_length, std::ptr::null_mut(), infoLog) };')
-                #print(r'             retrace::warning(call) << infoLog << "\n";')
-                #print(r'             delete [] infoLog;')
-                print(r'        }')
-            if self.map_function_regex.match(function.name):
+            if flags & CREATE_SHADER_PROGRAM:
+                print(r'        let program = _result;')
+            status_check = self.status_checks.get(name)
+            if status_check is not None:
+                print(self.status_check_template.format(**status_check))
+            if is_map:
                 #print(r'        if (!_result) {')
                 #print(r'             retrace::warning(call) << "failed to map buffer\n";')
                 #print(r'        }')
                 pass
-            if self.unmap_function_regex.match(function.name) and function.type is not stdapi.Void:
+            if is_unmap and function.type is not stdapi.Void:
                 #print(r'        if (!_result) {')
                 #print(r'             retrace::warning(call) << "failed to unmap buffer\n";')
                 #print(r'        }')
                 pass
-            if function.name in ('glGetAttribLocation', 'glGetAttribLocationARB'):
+            if name in {'glGetAttribLocation', 'glGetAttribLocationARB'}:
                 print(r'    let _origResult = call.ret.to_i32().unwrap();')
                 #print(r'    if (_result != _origResult) {')
                 #print(r'        retrace::warning(call) << "vertex attrib location mismatch " << _origResult << " -> " << _result << "\n";')
                 #print(r'    }')
-            if function.name in ('glCheckFramebufferStatus', 'glCheckFramebufferStatusEXT', 'glCheckNamedFramebufferStatus', 'glCheckNamedFramebufferStatusEXT'):
+            if name in {'glCheckFramebufferStatus', 'glCheckFramebufferStatusEXT', 'glCheckNamedFramebufferStatus', 'glCheckNamedFramebufferStatusEXT'}:
                 print(r'    let _origResult = call.ret.to_i32().unwrap();')
                 #print(r'    if (_origResult == GL_FRAMEBUFFER_COMPLETE &&')
                 #print(r'        _result != GL_FRAMEBUFFER_COMPLETE) {')
@@ -589,101 +828,118 @@ class GlRetracer(Retracer):
             #print('    }')
 
         # Query the buffer length for whole buffer mappings
-        if self.map_function_regex.match(function.name):
-            if 'length' in function.argNames():
-                assert 'BufferRange' in function.name
+        if is_map:
+            if 'length' in self.function_arg_names[name]:
+                assert 'BufferRange' in name
             else:
-                assert 'BufferRange' not in function.name
-                print(r'    let length = 0;')
-                if function.name in ('glMapBuffer', 'glMapBufferOES'):
-                    print(r'    unsafe { gl::GetBufferParameteriv(target, gl::BUFFER_SIZE, &length) };')
-                elif function.name == 'glMapBufferARB':
-                    print(r'    unsafe { gl::GetBufferParameterivARB(target, gl::BUFFER_SIZE_ARB, &length) };')
-                elif function.name == 'glMapNamedBuffer':
-                    print(r'    unsafe { gl::GetNamedBufferParameteriv(buffer, gl::BUFFER_SIZE, &length) };')
-                elif function.name == 'glMapNamedBufferEXT':
-                    print(r'    unsafe { gl::GetNamedBufferParameterivEXT(buffer, gl::BUFFER_SIZE, &length) };')
-                elif function.name == 'glMapObjectBufferATI':
-                    print(r'    unsafe { gl::GetObjectBufferivATI(buffer, gl::OBJECT_BUFFER_SIZE_ATI, &length) };')
+                assert 'BufferRange' not in name
+                # Prefer the size tracked from glBufferData/glBufferStorage,
+                # querying it only for buffers we haven't seen specified
+                cached, query = self.map_buffer_sizes[name]
+                if cached is None:
+                    print(self.map_length_query_template.format(query=query))
                 else:
-                    assert False
+                    print(self.map_length_template.format(cached=cached, query=query))
+            map_pointer_tracking = self.map_pointer_tracking.get(name)
+            if map_pointer_tracking is not None:
+                print(map_pointer_tracking)
+
+    def dependsOnLocation(self, type):
+        # Memoized per type, as most arguments share a handful of types
+        try:
+            return self.location_dependencies[type]
+        except KeyError:
+            collector = stdapi.Collector()
+            collector.visit(type)
+            depends = glapi.GLlocation in collector.types or \
+                      glapi.GLsubroutine in collector.types
+            self.location_dependencies[type] = depends
+            return depends
 
     def extractArg(self, function, arg, arg_type, lvalue, rvalue):
-        if function.name in self.array_pointer_function_names and arg.name == 'pointer':
-            print('    %s = region::to_pointer(%s, true);' % (lvalue, rvalue))
-            return
-
-        if self.draw_elements_function_regex.match(function.name) and arg.name == 'indices' or\
-           self.draw_indirect_function_regex.match(function.name) and arg.name == 'indirect':
-            self.extractOpaqueArg(function, arg, arg_type, lvalue, rvalue)
-            return
-
-        # Handle pointer with offsets into the current pack pixel buffer
-        # object.
-        if self.pack_function_regex.match(function.name) and arg.output:
-            assert isinstance(arg_type, (stdapi.Pointer, stdapi.Array, stdapi.Blob, stdapi.Opaque))
-            print('    let %s = (%s).to_pointer();' % (lvalue, rvalue))
-            return
-        if function.name.startswith('glGetQueryObject') and arg.output:
-            pointer_type = "%s" % (arg_type)
-            basetype = pointer_type.split(" ")[0]
-            print('    let retval: %s = 0;' % (basetype))
-            print('    if _query_buffer != 0 {')
-            print('        %s = (%s).to_pointer();' % (lvalue, rvalue))
-            print('    } else {')
-            print('        %s = retval };' % (lvalue))
-            return
-
-        if (arg.type.depends(glapi.GLlocation) or \
-            arg.type.depends(glapi.GLsubroutine)) \
-           and 'program' not in function.argNames():
+        flags = self.function_flags[function.name]
+        arg_names = self.function_arg_names[function.name]
+
+        # Test the argument name or direction first, as they rule out most
+        # arguments
+        if arg.name == 'pointer':
+            if flags & ARRAY_POINTER:
+                print(f'    {lvalue} = region::to_pointer({rvalue}, true);')
+                return
+        elif arg.name == 'indices':
+            if flags & DRAW_ELEMENTS:
+                self.extractOpaqueArg(function, arg, arg_type, lvalue, rvalue)
+                return
+        elif arg.name == 'indirect':
+            if flags & DRAW_INDIRECT:
+                self.extractOpaqueArg(function, arg, arg_type, lvalue, rvalue)
+                return
+
+        if arg.output:
+            # Handle pointer with offsets into the current pack pixel buffer
+            # object.
+            if flags & PACK:
+                assert isinstance(arg_type, self.pack_output_types)
+                print(f'    let {lvalue} = ({rvalue}).to_pointer();')
+                return
+            if flags & GET_QUERY_OBJECT:
+                # Element type of the output array
+                basetype = arg_type.type
+                print(self.query_object_output_template.format(basetype=basetype, lvalue=lvalue, rvalue=rvalue))
+                return
+
+        if 'program' not in arg_names and self.dependsOnLocation(arg.type):
             # Determine the active program for uniforms swizzling
-            print('    let program = _getActiveProgram();')
+            print('    let program = self.context.active_program();')
 
         if arg.type is glapi.GLlocationARB \
-           and 'programObj' not in function.argNames():
-            print('    let programObj = unsafe { gl::GetHandleARB(gl::PROGRAM_OBJECT_ARB) };')
+           and 'programObj' not in arg_names:
+            print('    let programObj = self.context.current_program();')
 
         Retracer.extractArg(self, function, arg, arg_type, lvalue, rvalue)
 
         # Don't try to use more samples than the implementation supports
         if arg.name == 'samples':
+            # The limits are queried once per context, see Context::max_samples
             if function.name == 'glRasterSamplesEXT':
                 assert arg.type is glapi.GLuint
-                print('    let max_samples = 0;')
-                print('    unsafe { gl::GetIntegerv(gl::MAX_RASTER_SAMPLES_EXT, &max_samples) };')
-                print('    if samples > max_samples {')
-                print('        samples = max_samples;')
-                print('    }')
+                print('    let max_samples = self.context.max_raster_samples_ext() as GLuint;')
             else:
                 assert arg.type is glapi.GLsizei
-                print('    let max_samples = 0;')
-                print('    unsafe { gl::GetIntegerv(gl::MAX_SAMPLES, &max_samples) };')
-                print('    if samples > max_samples {')
-                print('        samples = max_samples;')
-                print('    }')
+                print('    let max_samples = self.context.max_samples();')
+            print('    samples = samples.min(max_samples);')
 
         # These parameters are referred beyond the call life-time
         # TODO: Replace ad-hoc solution for bindable parameters with general one
-        if function.name in ('glFeedbackBuffer', 'glSelectBuffer') and arg.output:
-            print('    _allocator.bind(%s);' % arg.name)
+        if function.name in {'glFeedbackBuffer', 'glSelectBuffer'} and arg.output:
+            print(f'    _allocator.bind({arg.name});')
 
 
 
 if __name__ == '__main__':
-    print(r'''
+    # Generate the whole module in memory, and write it out at once
+    with contextlib.redirect_stdout(io.StringIO()) as output:
+        print(r'''
+
+use std::{ffi::c_void, ptr};
 
-use std::{collections::HashMap, ffi::c_void, ptr};
+use rustc_hash::FxHashMap as HashMap;
           
 use  gl::types::{GLbitfield, GLboolean, GLbyte, GLdouble, GLeglImageOES, GLenum, GLfixed, GLfloat, GLhalfNV, GLhandleARB, GLint, GLint64, GLintptr, GLshort, GLsizei, GLsizeiptr, GLsync, GLubyte, GLuint, GLuint64, GLushort, GLvoid};
 
-use crate::{call::Call, test::ScopedAllocator, gl_context::Context, region};
+use crate::{call::Call, test::ScopedAllocator, gl_context::Context, region, retracer::Callback};
 
 static DUMMY_CONTEXT: usize = 4000;
 static supportsARBShaderObjects: bool = false;
 static queryHandling: u8 = 0;
 static QUERY_RUN_AND_CHECK_RESULT: u8 = 2;
 static QUERY_SKIP: u8 = 0;
+
+#[cold]
+fn status_check_failed(message: &str) {
+    println!("{}", message);
+}
+
 //static GLint
 //_getActiveProgram(void);
 
@@ -691,19 +947,12 @@ static QUERY_SKIP: u8 = 0;
 //_validateActiveProgram(trace::Call &call);
 
 ''')
-    api = stdapi.API()
-    api.addModule(glapi.glapi)
-    retracer = GlRetracer()
-    retracer.retraceApi(api)
-
-    print(r'''
-fn _getActiveProgram() -> u32 {
-unsafe {
-    let mut program = 0;
-    unsafe { gl::GetIntegerv(gl::CURRENT_PROGRAM, &mut program) };
-    program as u32
-}
-}
+        api = stdapi.API()
+        api.addModule(glapi.glapi)
+        retracer = GlRetracer()
+        retracer.retraceApi(api)
+
+        print(r'''
 /*
 static void
 _validateActiveProgram(trace::Call &call)
@@ -742,3 +991,4 @@ _validateActiveProgram(trace::Call &call)
 }
 */
 ''')
+    sys.stdout.write(output.getvalue())
@@ -28,18 +28,44 @@
 
 
 # Adjust path
+import contextlib
+import functools
+import io
 import os.path
 import sys
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
 
 
 import specs.stdapi as stdapi
+from specs.stdapi import Handle, Pointer, Struct, Void
 
 
 class UnsupportedType(Exception):
     pass
 
-GLOB_ARRS = ["_list_map","_texture_map","_query_map","_buffer_map","_program_map","_shader_map","_location_map","_fence_map","_sync_map","_arrayAPPLE_map","_textureHandle_map","_sampler_map","_imageHandle_map","_feedback_map","_framebuffer_map","_renderbuffer_map","_array_map","_pipeline_map","_handleARB_map","_subroutine_map","_eglImageOES_map","_uniformBlock_map","_programARB_map","_fragmentShaderATI_map","_region_map"]
+GLOB_ARRS = frozenset(["_list_map","_texture_map","_query_map","_buffer_map","_program_map","_shader_map","_location_map","_fence_map","_sync_map","_arrayAPPLE_map","_textureHandle_map","_sampler_map","_imageHandle_map","_feedback_map","_framebuffer_map","_renderbuffer_map","_array_map","_pipeline_map","_handleARB_map","_subroutine_map","_eglImageOES_map","_uniformBlock_map","_programARB_map","_fragmentShaderATI_map","_region_map"])
+
+# Handles which map to GL_ARB_shader_objects handles when supported
+SHADER_OBJECT_HANDLES = frozenset(("program", "shader"))
+
+# Argument names which are Rust keywords
+RENAMED_ARGS = {"type": "_type", "ref": "_ref", "in": "_in"}
+
+# Vendor suffixes of extension functions, longest first
+EXTENSION_SUFFIXES = (
+    "GREMEDY", "ANGLE", "APPLE", "INTEL", "INGR", "MESA", "SGIS", "SGIX",
+    "ATIX", "SUNX", "3DFX", "AMD", "ARB", "ATI", "EXT", "IBM", "IMG", "KHR",
+    "NVX", "OES", "OVR", "PGI", "SGI", "SUN", "WIN", "HP", "NV",
+)
+
+
+@functools.lru_cache(maxsize=None)
+def moduleName(function_name):
+    '''Name of the module the retrace function of the given function goes into.'''
+    for suffix in EXTENSION_SUFFIXES:
+        if function_name.endswith(suffix):
+            return 'gl_' + suffix.lower()
+    return 'gl_core'
 
 
 def lookupHandle(handle, value, lval=False):
@@ -53,6 +79,112 @@ def lookupHandle(handle, value, lval=False):
             return "_%s_map[%s][%s]" % (handle.name, key_name, value)
 
 
+@functools.lru_cache(maxsize=None)
+def allocTypeName(type_name):
+    '''Element type name for allocating arrays of the given C type.'''
+    return type_name.replace('const', '').replace('*', '')
+
+
+@functools.lru_cache(maxsize=None)
+def sliceTypeName(type_name):
+    '''Rust slice element type name for the given C pointer type.'''
+    return type_name.replace('*', '').replace('void', 'c_void').strip()
+
+
+@functools.lru_cache(maxsize=None)
+def switchCases(polymorphic):
+    '''Memoized polymorphic.iterSwitch(), which regroups the switch types on
+    every call.'''
+    return polymorphic.iterSwitch()
+
+
+# Key of the per-context handle maps in the specs, and its Rust stand-in
+CURRENT_CONTEXT_KEY = 'reinterpret_cast<uintptr_t>(glretrace::getCurrentContext())'
+
+
+def handleEntry(entry):
+    '''Rust expression for a handle map entry returned by lookupHandle, which
+    always indexes one of the retracer's _*_map fields.'''
+    return 'self.' + entry.replace(CURRENT_CONTEXT_KEY, 'DUMMY_CONTEXT')
+
+
+def formatTemplate(code, placeholder, name):
+    '''Turn generated code into a str.format() template, replacing the
+    placeholder with a {name} field.'''
+    return code.replace('{', '{{').replace('}', '}}').replace(placeholder, '{%s}' % name)
+
+
+# Placeholder for the value substituted into cached handle snippets
+HANDLE_VALUE = '\0'
+
+
+@functools.lru_cache(maxsize=None)
+def handleLookupTemplate(handle):
+    '''Snippet mapping the traced handle in {lvalue} to the retraced one.'''
+    lvalue = HANDLE_VALUE
+    new_lvalue = lookupHandle(handle, lvalue)
+    lines = []
+    shaderObject = handle.name in SHADER_OBJECT_HANDLES
+    if shaderObject:
+        lines.append('if supportsARBShaderObjects {')
+        lines.append('    %s = self._handleARB_map[%s];' % (lvalue, lvalue))
+        lines.append('} else {')
+    lines.append('    %s = %s;' % (lvalue, handleEntry(new_lvalue)))
+    if shaderObject:
+        lines.append('}')
+    return formatTemplate('\n'.join(lines), HANDLE_VALUE, 'lvalue')
+
+
+@functools.lru_cache(maxsize=None)
+def handleRegistrationTemplate(handle):
+    '''Snippet recording the retraced handle in {lvalue} for the traced one
+    in _origResult.'''
+    lvalue = HANDLE_VALUE
+    lines = []
+    if handle.range is None:
+        rvalue = "_origResult"
+        entry = lookupHandle(handle, rvalue, True)
+        if handle.name in SHADER_OBJECT_HANDLES:
+            lines.append('if supportsARBShaderObjects {')
+            lines.append('    self._handleARB_map[%s] = %s;' % (rvalue, lvalue))
+            lines.append('} else {')
+            lines.append('    %s = %s;' % (entry, lvalue))
+            lines.append('}')
+        else:
+            lines.append('    %s = %s; ' % (handleEntry(entry), lvalue))
+        #if entry.startswith('_textureHandle_map') or entry.startswith('_imageHandle_map'):
+        #    print('    if (%s != %s) {' % (rvalue, lvalue))
+        #    print('        std::cout << "Bindless handle doesn\'t match, GPU failures ahead.\\n";')
+        #    print('    }')
+    else:
+        i = '_h' + handle.tag
+        lvalue = "%s + %s" % (lvalue, i)
+        rvalue = "_origResult + %s" % (i,)
+        entry = lookupHandle(handle, rvalue)
+        lines.append('    for %s in 0..%s {' % (i, handle.range))
+        lines.append('        %s = %s;' % (entry, lvalue))
+        lines.append('    }')
+    return formatTemplate('\n'.join(lines), HANDLE_VALUE, 'lvalue')
+
+
+# Types which ValueAllocator has nothing to allocate for
+NON_ALLOCATED_TYPES = (
+    stdapi.Literal, stdapi.Enum, stdapi.Bitmask, stdapi.IntPointer,
+    stdapi.ObjPointer, stdapi.LinearPointer, Handle, stdapi.Blob,
+    stdapi.String, Struct, stdapi.Opaque,
+)
+
+
+@functools.lru_cache(maxsize=None)
+def needsAllocation(type):
+    '''Whether ValueAllocator allocates anything for the given type.'''
+    if isinstance(type, (stdapi.Const, stdapi.Alias, stdapi.Reference)):
+        return needsAllocation(type.type)
+    if isinstance(type, stdapi.Polymorphic):
+        return needsAllocation(type.defaultType)
+    return not isinstance(type, NON_ALLOCATED_TYPES)
+
+
 class ValueAllocator(stdapi.Visitor):
 
     def visitLiteral(self, literal, lvalue, rvalue):
@@ -71,13 +203,13 @@ class ValueAllocator(stdapi.Visitor):
         pass
 
     def visitArray(self, array, lvalue, rvalue):
-        print('    %s = _allocator.alloc_array::<%s>(&%s);' % (lvalue, str(array.type).replace('const', '').replace('*', ''), rvalue))
+        print('    %s = _allocator.alloc_array::<%s>(&%s);' % (lvalue, allocTypeName(str(array.type)), rvalue))
 
     def visitAttribArray(self, array, lvalue, rvalue):
-        print('    %s = _allocator.alloc_array::<%s>(&%s);' % (lvalue, str(array.baseType).replace('const', '').replace('*', ''), rvalue))
+        print('    %s = _allocator.alloc_array::<%s>(&%s);' % (lvalue, allocTypeName(str(array.baseType)), rvalue))
 
     def visitPointer(self, pointer, lvalue, rvalue):
-        print('    %s = _allocator.alloc_array::<%s>(&%s);' % (lvalue, str(pointer.type).replace('const', '').replace('*', ''), rvalue))
+        print('    %s = _allocator.alloc_array::<%s>(&%s);' % (lvalue, allocTypeName(str(pointer.type)), rvalue))
 
     def visitIntPointer(self, pointer, lvalue, rvalue):
         pass
@@ -114,7 +246,7 @@ class ValueAllocator(stdapi.Visitor):
 class ValueDeserializer(stdapi.Visitor, stdapi.ExpanderMixin):
 
     def visitLiteral(self, literal, lvalue, rvalue):
-        print('    %s = (%s).to_%s().unwrap();' % (lvalue, rvalue, literal.kind))
+        print(f'    {lvalue} = ({rvalue}).to_{literal.kind}().unwrap();')
 
     def visitConst(self, const, lvalue, rvalue):
         self.visit(const.type, lvalue, rvalue)
@@ -124,23 +256,32 @@ class ValueDeserializer(stdapi.Visitor, stdapi.ExpanderMixin):
     
     def visitEnum(self, enum, lvalue, rvalue):
         if (enum.expr == 'GLboolean'):
-            print('    %s = (%s).to_u32().unwrap() as u8;' % (lvalue, rvalue))
+            print(f'    {lvalue} = ({rvalue}).to_u32().unwrap() as u8;')
         else:
-            print('    %s = (%s).to_u32().unwrap().try_into().unwrap();' % (lvalue, rvalue))
+            print(f'    {lvalue} = ({rvalue}).to_u32().unwrap().try_into().unwrap();')
 
     def visitBitmask(self, bitmask, lvalue, rvalue):
-        print('    %s = (%s).to_u32().unwrap().try_into().unwrap();' % (lvalue, rvalue))
+        print(f'    {lvalue} = ({rvalue}).to_u32().unwrap().try_into().unwrap();')
 
     def visitArray(self, array, lvalue, rvalue):
         tmp = '_a_' + array.tag + '_' + str(self.seq)
         self.seq += 1
 
-        print('    let %s = (%s).to_array();' % (tmp, rvalue))
-        print('    if let Some(%s) = %s {' % (tmp, tmp))
+        # Array members of known size are always present, and are filled in
+        # place with a fixed count loop
+        fixed = self.insideStruct and isinstance(array.length, int)
+
+        if fixed:
+            print(f'    let {tmp} = ({rvalue}).to_array().unwrap();')
+        else:
+            print('\n'.join([
+                f'    let {tmp} = ({rvalue}).to_array();',
+                f'    if let Some({tmp}) = {tmp} {{',
+            ]))
 
         length = '%s.values.len()' % (tmp,)
         if self.insideStruct:
-            if isinstance(array.length, int):
+            if fixed:
                 # Member is an array
                 #NOTE: Getting rid of any asserts
                 #print(r'    static_assert( std::is_array< std::remove_reference< decltype( %s ) >::type >::value , "lvalue must be an array" );' % lvalue)
@@ -152,16 +293,21 @@ class ValueDeserializer(stdapi.Visitor, stdapi.ExpanderMixin):
                 # Member is a pointer to an array, hence must be allocated
                 #NOTE: Getting rid of any asserts
                 #print(r'    static_assert( std::is_pointer< std::remove_reference< decltype( %s ) >::type >::value , "lvalue must be a pointer" );' % lvalue)
-                print(r'    %s = _allocator.allocArray<%s>(&%s);' % (lvalue, array.type, rvalue))
+                print(rf'    {lvalue} = _allocator.allocArray<{array.type}>(&{rvalue});')
 
         index = '_j' + array.tag
-        print('        for {i} in 0..{length} {{'.format(i = index, length = length))
+        print(f'        for {index} in 0..{length} {{')
         try:
-            self.visit(array.type, '%s[%s]' % (lvalue, index), '*%s.values[%s]' % (tmp, index))
+            self.visit(array.type, f'{lvalue}[{index}]', f'*{tmp}.values[{index}]')
         finally:
-            print('        }')
-            print('    }')
-            print("    let %s = %s.as_mut_ptr();" % (lvalue, lvalue))
+            if fixed:
+                print('        }')
+            else:
+                print('\n'.join([
+                    '        }',
+                    '    }',
+                    f'    let {lvalue} = {lvalue}.as_mut_ptr();',
+                ]))
 
     def visitAttribArray(self, array, lvalue, rvalue):
         tmp = '_a_' + array.tag + '_' + str(self.seq)
@@ -169,17 +315,20 @@ class ValueDeserializer(stdapi.Visitor, stdapi.ExpanderMixin):
 
         assert not self.insideStruct
 
-        print('    let %s = (%s).to_array().unwrap();' % (tmp, rvalue))
-        print('    if (%s) {' % (tmp,))
-
         length = '%s.values.len()' % (tmp,)
         index = '_j' + array.tag
-        print('        for {i} in {i}..{length} {{'.format(i = index, length = length))
+        print('\n'.join([
+            f'    let {tmp} = ({rvalue}).to_array().unwrap();',
+            f'    if ({tmp}) {{',
+            f'        for {index} in {index}..{length} {{',
+        ]))
         try:
-            self.visit(array.baseType, '%s[%s]' % (lvalue, index), '%s.values[%s]' % (tmp, index))
+            self.visit(array.baseType, f'{lvalue}[{index}]', f'{tmp}.values[{index}]')
         finally:
-            print('        }')
-            print('    }')
+            print('\n'.join([
+                '        }',
+                '    }',
+            ]))
     
     def visitPointer(self, pointer, lvalue, rvalue):
         tmp = '_a_' + pointer.tag + '_' + str(self.seq)
@@ -188,10 +337,10 @@ class ValueDeserializer(stdapi.Visitor, stdapi.ExpanderMixin):
         if self.insideStruct:
             # Member is a pointer to an object, hence must be allocated
             #print(r'    static_assert( std::is_pointer< std::remove_reference< decltype( %s ) >::type >::value , "lvalue must be a pointer" );' % lvalue)
-            print(r'    %s = _allocator.allocArray<%s>(&%s);' % (lvalue, pointer.type, rvalue))
+            print(rf'    {lvalue} = _allocator.allocArray<{pointer.type}>(&{rvalue});')
 
         #print('    if (%s) {' % (lvalue,))
-        print('    let %s = (%s).to_array().unwrap();' % (tmp, rvalue))
+        print(f'    let {tmp} = ({rvalue}).to_array().unwrap();')
         try:
             self.visit(pointer.type, '%s[0]' % (lvalue,), '%s.values[0]' % (tmp,))
         finally:
@@ -200,15 +349,15 @@ class ValueDeserializer(stdapi.Visitor, stdapi.ExpanderMixin):
 
     def visitIntPointer(self, pointer, lvalue, rvalue):
         if str(lvalue).find('indices') == -1:
-            print('    let %s = (%s).to_pointer().unwrap() as *mut c_void;' % (lvalue, rvalue))
+            print(f'    let {lvalue} = ({rvalue}).to_pointer().unwrap() as *mut c_void;')
         else:
-            print('            %s = (%s).to_pointer().unwrap() as *mut c_void;' % (lvalue, rvalue))
+            print(f'            {lvalue} = ({rvalue}).to_pointer().unwrap() as *mut c_void;')
 
     def visitObjPointer(self, pointer, lvalue, rvalue):
-        print('    %s = retrace::asObjPointer<%s>(call, %s);' % (lvalue, pointer.type, rvalue))
+        print(f'    {lvalue} = retrace::asObjPointer<{pointer.type}>(call, {rvalue});')
 
     def visitLinearPointer(self, pointer, lvalue, rvalue):
-        print('    %s = region::to_pointer(%s);' % (lvalue, pointer, rvalue))
+        print(f'    {lvalue} = region::to_pointer({rvalue});')
 
     def visitReference(self, reference, lvalue, rvalue):
         self.visit(reference.type, lvalue, rvalue);
@@ -216,39 +365,34 @@ class ValueDeserializer(stdapi.Visitor, stdapi.ExpanderMixin):
     def visitHandle(self, handle, lvalue, rvalue):
         #OpaqueValueDeserializer().visit(handle.type, lvalue, rvalue);
         self.visit(handle.type, lvalue, rvalue);
-        new_lvalue = lookupHandle(handle, lvalue)
-        shaderObject = new_lvalue.startswith('_program_map') or new_lvalue.startswith('_shader_map')
-        if shaderObject:
-            print('if supportsARBShaderObjects {')
-            #print('    if (retrace::verbosity >= 2) {')
-            #print('        std::cout << "%s " << size_t(%s) << " <- " << size_t(_handleARB_map[%s]) << "\\n";' % (handle.name, lvalue, lvalue))
-            #print('    }')
-            print('    %s = self._handleARB_map[%s];' % (lvalue, lvalue))
-            print('} else {')
         #print('    if (retrace::verbosity >= 2) {')
         #print('        std::cout << "%s " << size_t(%s) << " <- " << size_t(%s) << "\\n";' % (handle.name, lvalue, new_lvalue))
         #print('    }')
-        print('    %s = %s;' % (lvalue, ('self.' if str(new_lvalue)[0] == '_' else '') + str(new_lvalue).replace('reinterpret_cast<uintptr_t>(glretrace::getCurrentContext())', 'DUMMY_CONTEXT')))
-        if shaderObject:
-            print('}')
+        print(handleLookupTemplate(handle).format(lvalue=lvalue))
     
     def visitBlob(self, blob, lvalue, rvalue):
-        print('    let %s = (%s).to_pointer().unwrap() as *mut c_void;' % (lvalue, rvalue))
+        print(f'    let {lvalue} = ({rvalue}).to_pointer().unwrap() as *mut c_void;')
     
     def visitString(self, string, lvalue, rvalue):
-        print('    %s = (%s).to_string().unwrap();' % (lvalue, rvalue))
+        print(f'    {lvalue} = ({rvalue}).to_string().unwrap();')
 
     seq = 0
 
     insideStruct = 0
 
+    def reset(self):
+        # Temporaries are numbered per value, and an unsupported member may
+        # have left us inside a struct
+        self.seq = 0
+        self.insideStruct = 0
+
     def visitStruct(self, struct, lvalue, rvalue):
         tmp = '_s_' + struct.tag + '_' + str(self.seq)
         self.seq += 1
 
         self.insideStruct += 1
 
-        print('    let %s = (%s).to_struct().unwrap();' % (tmp, rvalue))
+        print(f'    let {tmp} = ({rvalue}).to_struct().unwrap();')
         #print('    assert(%s);' % (tmp))
         for i in range(len(struct.members)):
             member = struct.members[i]
@@ -259,10 +403,10 @@ class ValueDeserializer(stdapi.Visitor, stdapi.ExpanderMixin):
     def visitPolymorphic(self, polymorphic, lvalue, rvalue):
         if polymorphic.defaultType is None:
             switchExpr = self.expand(polymorphic.switchExpr)
-            print(r'    switch (%s) {' % switchExpr)
-            for cases, type in polymorphic.iterSwitch():
+            print(rf'    switch ({switchExpr}) {{')
+            for cases, type in switchCases(polymorphic):
                 for case in cases:
-                    print(r'    %s:' % case)
+                    print(rf'    {case}:')
                 caseLvalue = lvalue
                 if type.expr is not None:
                     caseLvalue = 'static_cast<%s>(%s)' % (type, caseLvalue)
@@ -273,9 +417,11 @@ class ValueDeserializer(stdapi.Visitor, stdapi.ExpanderMixin):
                     print(r'        }')
                 print(r'        break;')
             if polymorphic.defaultType is None:
-                print(r'    default:')
-                print(r'        retrace::warning(call) << "unexpected polymorphic case" << %s << "\n";' % (switchExpr,))
-                print(r'        break;')
+                print('\n'.join([
+                    r'    default:',
+                    rf'        retrace::warning(call) << "unexpected polymorphic case" << {switchExpr} << "\n";',
+                    r'        break;',
+                ]))
             print(r'    }')
         else:
             self.visit(polymorphic.defaultType, lvalue, rvalue)
@@ -291,7 +437,7 @@ class OpaqueValueDeserializer(ValueDeserializer):
     in the context of handles.'''
 
     def visitOpaque(self, opaque, lvalue, rvalue):
-        print('    %s = region::to_pointer(%s);' % (lvalue, rvalue))
+        print(f'    {lvalue} = region::to_pointer({rvalue});')
 
 
 class SwizzledValueRegistrator(stdapi.Visitor, stdapi.ExpanderMixin):
@@ -311,20 +457,26 @@ class SwizzledValueRegistrator(stdapi.Visitor, stdapi.ExpanderMixin):
         pass
 
     def visitArray(self, array, lvalue, rvalue):
-        print('    let _a%s = (%s).to_array();' % (array.tag, rvalue))
-        print('    if (_a%s) {' % (array.tag))
         length = '_a%s.values.len()' % array.tag
         index = '_j' + array.tag
-        print('        for {i} in 0..{length} {{'.format(i = index, length = length))  ##print('        for (size_t {i} = 0; {i} < {length}; ++{i}) {{'.format(i = index, length = length))
+        print('\n'.join([
+            f'    let _a{array.tag} = ({rvalue}).to_array();',
+            f'    if (_a{array.tag}) {{',
+            f'        for {index} in 0..{length} {{',  ##print('        for (size_t {i} = 0; {i} < {length}; ++{i}) {{'.format(i = index, length = length))
+        ]))
         try:
             self.visit(array.type, '%s[%s]' % (lvalue, index), '_a%s.values[%s]' % (array.tag, index))
         finally:
-            print('        }')
-            print('    }')
+            print('\n'.join([
+                '        }',
+                '    }',
+            ]))
     
     def visitPointer(self, pointer, lvalue, rvalue):
-        print('    let _a%s = (%s).to_array();' % (pointer.tag, rvalue))
-        print('    if (_a%s) {' % (pointer.tag))
+        print('\n'.join([
+            f'    let _a{pointer.tag} = ({rvalue}).to_array();',
+            f'    if (_a{pointer.tag}) {{',
+        ]))
         try:
             self.visit(pointer.type, '%s[0]' % (lvalue,), '_a%s.values[0]' % (pointer.tag,))
         finally:
@@ -334,49 +486,20 @@ class SwizzledValueRegistrator(stdapi.Visitor, stdapi.ExpanderMixin):
         pass
     
     def visitObjPointer(self, pointer, lvalue, rvalue):
-        print(r'    region::add_obj(call, %s, %s);' % (rvalue, lvalue))
+        print(rf'    region::add_obj(call, {rvalue}, {lvalue});')
     
     def visitLinearPointer(self, pointer, lvalue, rvalue):
         assert pointer.size is not None
         if pointer.size is not None:
-            print(r'    region::add_region(call, (%s).toUIntPtr(), %s, %s);' % (rvalue, lvalue, pointer.size))
+            print(rf'    region::add_region(call, ({rvalue}).toUIntPtr(), {lvalue}, {pointer.size});')
 
     def visitReference(self, reference, lvalue, rvalue):
         pass
     
     def visitHandle(self, handle, lvalue, rvalue):
-        print('    let _origResult: %s;' % handle.type)
+        print(f'    let _origResult: {handle.type};')
         OpaqueValueDeserializer().visit(handle.type, '_origResult', rvalue);
-        if handle.range is None:
-            rvalue = "_origResult"
-            entry = lookupHandle(handle, rvalue, True)
-            if (entry.startswith('_program_map') or entry.startswith('_shader_map')):
-                print('if supportsARBShaderObjects {')
-                print('    self._handleARB_map[%s] = %s;' % (rvalue, lvalue))
-                print('} else {')
-                print('    %s = %s;' % (entry, lvalue))
-                print('}')
-            else:
-                print("    %s = %s; " % (('self.' if str(entry)[0] == '_' else '') + str(entry).replace('reinterpret_cast<uintptr_t>(glretrace::getCurrentContext())', 'DUMMY_CONTEXT'), lvalue))
-            #if entry.startswith('_textureHandle_map') or entry.startswith('_imageHandle_map'):
-            #    print('    if (%s != %s) {' % (rvalue, lvalue))
-            #    print('        std::cout << "Bindless handle doesn\'t match, GPU failures ahead.\\n";')
-            #    print('    }')
-
-            #print('    if (retrace::verbosity >= 2) {')
-            #print('        std::cout << "{handle.name} " << {rvalue} << " -> " << {lvalue} << "\\n";'.format(**locals()))
-            #print('    }')
-        else:
-            i = '_h' + handle.tag
-            lvalue = "%s + %s" % (lvalue, i)
-            rvalue = "_origResult + %s" % (i,)
-            entry = lookupHandle(handle, rvalue) 
-            print('    for {i} in 0..{handle.range} {{'.format(**locals()))
-            print('        {entry} = {lvalue};'.format(**locals()))
-            #print('        if (retrace::verbosity >= 2) {')
-            #print('            std::cout << "{handle.name} " << ({rvalue}) << " -> " << ({lvalue}) << "\\n";'.format(**locals()))
-            #print('        }')
-            print('    }')
+        print(handleRegistrationTemplate(handle).format(lvalue=lvalue))
     
     def visitBlob(self, blob, lvalue, rvalue):
         pass
@@ -386,11 +509,15 @@ class SwizzledValueRegistrator(stdapi.Visitor, stdapi.ExpanderMixin):
 
     seq = 0
 
+    def reset(self):
+        # Temporaries are numbered per value
+        self.seq = 0
+
     def visitStruct(self, struct, lvalue, rvalue):
         tmp = '_s_' + struct.tag + '_' + str(self.seq)
         self.seq += 1
 
-        print('    let %s = (%s).to_struct();' % (tmp, rvalue))
+        print(f'    let {tmp} = ({rvalue}).to_struct();')
         #print('    assert(%s);' % (tmp,))
         #print('    (void)%s;' % (tmp,))
         for i in range(len(struct.members)):
@@ -407,20 +534,35 @@ class SwizzledValueRegistrator(stdapi.Visitor, stdapi.ExpanderMixin):
 
 class Retracer:
 
+    def __init__(self):
+        # Visitors are reused for every value, being reset before each one
+        self.valueAllocator = ValueAllocator()
+        self.valueDeserializer = ValueDeserializer()
+        self.opaqueValueDeserializer = OpaqueValueDeserializer()
+        self.swizzledValueRegistrator = SwizzledValueRegistrator()
+
     def makeFunctionId(self, function):
+        # Memoized, as both the definition and the callback lookup need it
+        try:
+            return self.function_ids[function]
+        except KeyError:
+            pass
         name = function.name
         if function.overloaded:
             # TODO: Use a sequence number
             name += '__%08x' % (hash(function) & 0xffffffff)
+        self.function_ids[function] = name
         return name
 
     def retraceFunction(self, function):
+        print('#[inline(never)]')
         print('pub fn retrace_%s(&mut self, call: &mut Call) {' % self.makeFunctionId(function))
         self.retraceFunctionBody(function)
         print('}')
         print()
 
     def retraceInterfaceMethod(self, interface, method):
+        print('#[inline(never)]')
         print('pub fn retrace_%s__%s(&mut self, call: &mut Call) {' % (interface.name, self.makeFunctionId(method)))
         self.retraceInterfaceMethodBody(interface, method)
         print('}')
@@ -429,7 +571,7 @@ class Retracer:
     def retraceFunctionBody(self, function):
         assert function.sideeffects
 
-        if function.type is not stdapi.Void:
+        if function.type is not Void:
             self.checkOrigResult(function)
 
         self.deserializeArgs(function)
@@ -447,7 +589,7 @@ class Retracer:
     def retraceInterfaceMethodBody(self, interface, method):
         assert method.sideeffects
 
-        if method.type is not stdapi.Void:
+        if method.type is not Void:
             self.checkOrigResult(method)
 
         self.deserializeThisPointer(interface)
@@ -464,7 +606,7 @@ class Retracer:
         where the original did not, which would cause diversion and potentially
         unpredictable results.'''
 
-        assert function.type is not stdapi.Void
+        assert function.type is not Void
 
         if str(function.type) == 'HRESULT':
             print(r'    if !call.ret.is_none() && call.ret.to_i32().is_none() {')
@@ -483,21 +625,18 @@ class Retracer:
         print('    let _ = &_allocator;')
         success = True
         for arg in function.args:
-            if arg.name == "type":
-                arg.name = "_type"
-            elif arg.name == "ref":
-                arg.name = "_ref"
-            elif arg.name == "in":
-                arg.name = "_in"
+            if arg.name in RENAMED_ARGS:
+                arg.name = RENAMED_ARGS[arg.name]
             elif arg.name in GLOB_ARRS:
                 arg.name = 'self.' + arg.name
             arg_type = arg.type.mutable() #TODO: Make this be rustable
             arg_type.expr = arg_type.expr.replace('const', '').strip()
             if arg.name != "pixels":
-                if str(arg_type).find('*') == -1:
-                    print('    let mut %s: %s;' % (arg.name, arg_type))
+                type_name = str(arg_type)
+                if '*' not in type_name:
+                    print('    let mut %s: %s;' % (arg.name, type_name))
                 else:
-                    print('    let %s: &mut [%s];' % (arg.name, str(arg_type).replace('*', '').replace('void', 'c_void').strip()))
+                    print('    let %s: &mut [%s];' % (arg.name, sliceTypeName(type_name)))
             rvalue = 'call.arg(%u)' % (arg.index,)
             lvalue = arg.name
             try:
@@ -523,7 +662,7 @@ class Retracer:
                     self.regiterSwizzledValue(arg_type, lvalue, rvalue)
                 except UnsupportedType:
                     print('    // XXX: %s' % arg.name)
-        if function.type is not stdapi.Void:
+        if function.type is not Void:
             rvalue = '*call.ret'
             lvalue = '_result'
             try:
@@ -539,23 +678,28 @@ class Retracer:
     #    print('    return;')
 
     def extractArg(self, function, arg, arg_type, lvalue, rvalue):
-        ValueAllocator().visit(arg_type, lvalue, rvalue)
+        if needsAllocation(arg_type):
+            self.valueAllocator.visit(arg_type, lvalue, rvalue)
         if arg.input:
-            ValueDeserializer().visit(arg_type, lvalue, rvalue)
+            self.valueDeserializer.reset()
+            self.valueDeserializer.visit(arg_type, lvalue, rvalue)
     
     def extractOpaqueArg(self, function, arg, arg_type, lvalue, rvalue):
         try:
-            ValueAllocator().visit(arg_type, lvalue, rvalue)
+            if needsAllocation(arg_type):
+                self.valueAllocator.visit(arg_type, lvalue, rvalue)
         except UnsupportedType:
             pass
-        OpaqueValueDeserializer().visit(arg_type, lvalue, rvalue)
+        self.opaqueValueDeserializer.reset()
+        self.opaqueValueDeserializer.visit(arg_type, lvalue, rvalue)
 
     def regiterSwizzledValue(self, type, lvalue, rvalue):
-        visitor = SwizzledValueRegistrator()
+        visitor = self.swizzledValueRegistrator
+        visitor.reset()
         visitor.visit(type, lvalue, rvalue)
 
     def declareRet(self, function):
-        if function.type is not stdapi.Void:
+        if function.type is not Void:
             pass
             #print('    %s _result;' % (function.type))
 
@@ -564,15 +708,17 @@ class Retracer:
         #
         # XXX: Find a better name
         self.doInvokeFunction(function)
-        if function.type is not stdapi.Void:
+        if function.type is not Void:
             self.checkResult(None, function)
 
     def doInvokeFunction(self, function):
-        arg_names = ", ".join(function.argNames())
-        if function.type is not stdapi.Void:
-            print('    let _result = unsafe { gl::%s(%s) };' % (function.name.replace('gl', '', 1), arg_names))
+        # Argument names are only final once the arguments were deserialized
+        # (keywords and handle maps get renamed), so this can't be cached
+        ffi_call = 'unsafe { gl::%s(%s) };' % (function.name.replace('gl', '', 1), ", ".join(function.argNames()))
+        if function.type is not Void:
+            print('    let _result = ' + ffi_call)
         else:
-            print('    unsafe { gl::%s(%s) };' % (function.name.replace('gl', '', 1), arg_names))
+            print('    ' + ffi_call)
 
     def doInvokeInterfaceMethod(self, interface, method):
         # Same as invokeInterfaceMethod, but without error checking
@@ -580,7 +726,7 @@ class Retracer:
         # XXX: Find a better name
 
         arg_names = ", ".join(method.argNames())
-        if method.type is not stdapi.Void:
+        if method.type is not Void:
             print('    _result = _this.%s(%s);' % (method.name, arg_names))
         else:
             print('    _this.%s(%s);' % (method.name, arg_names))
@@ -619,11 +765,11 @@ class Retracer:
     def invokeInterfaceMethod(self, interface, method):
         self.doInvokeInterfaceMethod(interface, method)
 
-        if method.type is not stdapi.Void:
+        if method.type is not Void:
             self.checkResult(interface, method)
 
     def checkResult(self, interface, methodOrFunction):
-        assert methodOrFunction.type is not stdapi.Void
+        assert methodOrFunction.type is not Void
         if str(methodOrFunction.type) == 'HRESULT':
             print(r'    if (FAILED(_result)) {')
             print(r'        retrace::failed(call, _result);')
@@ -640,8 +786,8 @@ class Retracer:
         # FIXME: We should try to swizzle them.  It's a bit of work, but possible.
         for outArg in method.args:
             if outArg.output \
-               and isinstance(outArg.type, stdapi.Pointer) \
-               and isinstance(outArg.type.type, stdapi.Struct):
+               and isinstance(outArg.type, Pointer) \
+               and isinstance(outArg.type.type, Struct):
                 print(r'        let _%s = call.arg(%u).to_array().unwrap();' % (outArg.name, outArg.index))
                 print(r'        if !%s,is_none() {' % outArg.name)
                 print(r'            let _struct = _%s.values[0].to_struct().unwrap();' % (outArg.name))
@@ -659,8 +805,6 @@ class Retracer:
     def filterFunction(self, function):
         return True
 
-    table_name = 'retrace::callbacks'
-
     def retraceApi(self, api):
 
         #print('#include "os_time.hpp"')
@@ -670,53 +814,85 @@ class Retracer:
         
         print()
 
-        types = api.getAllTypes()
-        handles = [type for type in types if isinstance(type, stdapi.Handle)]
-        handle_names = set()
+        self.function_ids = {}
+
+        # One map per handle name, declared after its first handle
+        handles_by_name = {}
+        for type in api.getAllTypes():
+            if isinstance(type, Handle):
+                handles_by_name.setdefault(type.name, type)
         print("pub struct GlRetracer {") 
         print("    context: Context,")
-        for handle in handles:
-            if handle.name not in handle_names:
-                if handle.key is None:
-                    print('    _%s_map: region::Map<%s>,' % (handle.name, handle.type))
-                else:
-                    key_name, key_type = handle.key
-                    print('    _%s_map: HashMap<%s, region::Map<%s> >,' % (handle.name, str(key_type).replace('uintptr_t', 'usize'), handle.type))
-                handle_names.add(handle.name)
+        for handle in handles_by_name.values():
+            if handle.key is None:
+                print('    _%s_map: region::Map<%s>,' % (handle.name, handle.type))
+            else:
+                key_name, key_type = handle.key
+                print('    _%s_map: HashMap<%s, region::Map<%s> >,' % (handle.name, str(key_type).replace('uintptr_t', 'usize'), handle.type))
         print("}")
         print()
 
+        functions = [function for function in api.getAllFunctions() if self.filterFunction(function)]
+        # Only public functions get callbacks, and only those with side
+        # effects need retracing
+        public_functions = [function for function in functions if not function.internal]
+
+        # One module per extension vendor, so that rustc can split the
+        # retrace functions across codegen units
+        modules = {}
+        for function in public_functions:
+            if function.sideeffects:
+                with contextlib.redirect_stdout(io.StringIO()) as code:
+                    self.retraceFunction(function)
+                modules.setdefault(moduleName(function.name), []).append(code.getvalue())
+        for module, codes in modules.items():
+            print('mod %s {' % module)
+            print('use super::*;')
+            print()
+            print('impl GlRetracer {')
+            print(''.join(codes), end='')
+            print('}')
+            print('}')
+            print()
+
         print("impl GlRetracer {")
-        functions = list(filter(self.filterFunction, api.getAllFunctions()))
-        for function in functions:
-            if function.sideeffects and not function.internal:
-                self.retraceFunction(function)
         interfaces = api.getAllInterfaces()
         for interface in interfaces:
             for method in interface.methods:
                 if method.sideeffects and not method.internal:
                     self.retraceInterfaceMethod(interface, method)
         print("""
-    fn ignore(&mut self, call: &Call) {}
+    fn ignore(&mut self, _call: &mut Call) {}
 """)
         print("}")
         print()
-        print('static %s: [(&\'static str, Callback); %d] = [' % (self.table_name, len(functions)))
-        for function in functions:
-            if not function.internal:
-                sigName = function.sigName()
-                if function.sideeffects:
-                    print('    ("%s", GlRetracer::retrace_%s),' % (sigName, self.makeFunctionId(function)))
-                else:
-                    print('    ("%s", GlRetracer::ignore),' % (sigName,))
+        # Signature names and their callbacks
+        callbacks = [
+            (function.sigName(), 'GlRetracer::retrace_%s' % self.makeFunctionId(function))
+            if function.sideeffects else
+            (function.sigName(), 'GlRetracer::ignore')
+            for function in public_functions
+        ]
         for interface in interfaces:
-            for base, method in interface.iterBaseMethods():
-                sigName = method.sigName()
-                if method.sideeffects:
-                    print('    ("%s::%s", retrace_%s__%s),' % (interface.name, sigName, base.name, self.makeFunctionId(method)))
-                else:
-                    print('    ("%s::%s", ignore),' % (interface.name, sigName))
-        #print('    {NULL, NULL}')
-        print('];')
+            callbacks.extend([
+                ('%s::%s' % (interface.name, method.sigName()), 'retrace_%s__%s' % (base.name, self.makeFunctionId(method)))
+                if method.sideeffects else
+                ('%s::%s' % (interface.name, method.sigName()), 'ignore')
+                for base, method in interface.iterBaseMethods()
+            ])
+
+        # Looked up the first time each signature is seen, which rustc
+        # compiles into a decision tree on the name length and bytes
+        rows = [
+            'pub fn lookup_callback(name: &str) -> Option<Callback> {',
+            '    match name {',
+        ]
+        rows.extend([f'        "{sigName}" => Some({callback}),' for sigName, callback in callbacks])
+        rows.extend([
+            '        _ => None,',
+            '    }',
+            '}',
+        ])
+        print('\n'.join(rows))
 
 
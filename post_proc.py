@@ -1,41 +1,142 @@
-import json;
-
-errors = []
-with open('errors.json') as json_file:
-    scode = []
-    with open('helpers/try.rs', 'r') as helpers_file:
-        scode = helpers_file.readlines()
-    for line in json_file:
-        errors.append(json.loads(line))
-    for line in errors:
-        try:
-            if(line["message"]["level"] == "error"):
-                if (line["message"]["spans"][0]["is_primary"]):
-                    if (line["message"]["spans"][0]["text"][0]["text"].find("unsafe { gl::") != -1):
-                        pos = line["message"]["spans"][0]["line_end"]-1
-                        scode[pos] = "//not found in gl!" + scode[pos]
-                else:
-                    if (line["message"]["spans"][1]["text"][0]["text"].find("unsafe { gl::") != -1):
-                        pos = line["message"]["spans"][1]["line_end"]-1
-                        scode[pos] = "//not found in gl!" + scode[pos] 
-
-            # if (line["reason"] != "compiler-artifact" and line["reason"].find('compiler') != -1):
-            #     if(line["message"]["spans"][0]["label"] == "not found in `gl`"):
-            #         pos = line["message"]["spans"][0]["line_start"]-1
-            #         scode[pos] = "//not found in gl!" + scode[pos]
-            #         if(scode[pos].find("let _result") != -1):
-            #             scode[pos] = scode[pos] + "\nlet _result = 0;"
-            #     if(line["message"]["spans"][0]["label"] == "not found in this scope" and line["message"]["spans"][0]["text"][0]["text"].find("pub") == -1 and line["message"]["spans"][0]["text"][0]["text"].find("if") == -1 and line["message"]["spans"][0]["text"][0]["text"].find("let") == -1 and line["message"]["spans"][0]["text"][0]["text"].find("for") == -1):
-            #         pos = line["message"]["spans"][0]["line_end"]-1
-            #         scode[pos] = "//not found in scope!" + scode[pos]
-            #     try:
-            #         print(line["message"]["spans"]) if (line["message"]["spans"][0]["label"]!= "not found in `gl`" and line["message"]["spans"][0]["label"].find("use of unresolved module or unlinked crate `") == -1) else 0
-            #         if(line["message"]["spans"][1]["label"] == "similarly named function `ColorP3ui` defined here"):
-            #             pos = line["message"]["spans"][0]["line_start"]-1
-            #             scode[pos] = "//not found in gl!" + scode[pos]
-            #     except:
-            #         pass
-        except Exception as e:
-            print(e)
-    with open('helpers/try.rs', 'w') as helpers_file:
-        helpers_file.writelines(scode)
\ No newline at end of file
+import concurrent.futures
+import itertools
+import mmap
+import os
+
+try:
+    import orjson as json
+except ImportError:
+    import json
+
+# Generated FFI calls, the only lines that get commented out
+GL_CALL = "unsafe { gl::"
+GL_CALL_BYTES = GL_CALL.encode()
+MARK = b"//not found in gl!"
+
+# Size of errors.json handled by each process, below which starting them
+# costs more than the parse
+PARALLEL_CHUNK_SIZE = 64 << 20
+
+
+def collectMarks(path, begin, end):
+    '''Indices of the try.rs lines reported by the messages between the
+    given offsets of errors.json.'''
+    # A line reported more than once is still only marked once
+    marks = set()
+    with open(path, 'rb') as json_file:
+        json_file.seek(begin)
+        offset = begin
+        # One message per line, read one at a time. Only compiler messages
+        # carry diagnostics, and cargo always writes their reason first, so
+        # the rest (artifacts, build script runs) isn't parsed at all
+        while offset < end:
+            raw = json_file.readline()
+            if not raw:
+                break
+            offset += len(raw)
+            if not raw.startswith(b'{"reason":"compiler-message"'):
+                continue
+            # The span text is stored verbatim, so messages which can't match
+            # are skipped before decoding them
+            if GL_CALL_BYTES not in raw:
+                continue
+            try:
+                line = json.loads(raw)
+            except ValueError as e:
+                print(e)
+                continue
+            # Anything but errors is skipped without raising
+            message = line.get("message")
+            if not message or message.get("level") != "error":
+                continue
+            spans = message.get("spans")
+            if not spans:
+                continue
+            # The call is in the primary span, or else in the second one
+            if spans[0].get("is_primary"):
+                span = spans[0]
+            elif len(spans) > 1:
+                span = spans[1]
+            else:
+                continue
+            text = span.get("text")
+            if text and GL_CALL in text[0]["text"]:
+                pos = span["line_end"]-1
+                marks.add(pos)
+    return marks
+
+
+def splitMessages(path, count):
+    '''Offsets splitting errors.json into count chunks of whole lines.'''
+    size = os.path.getsize(path)
+    offsets = [0]
+    with open(path, 'rb') as json_file, \
+         mmap.mmap(json_file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        for i in range(1, count):
+            end = data.find(b'\n', max(size * i // count, offsets[-1]))
+            offsets.append(size if end == -1 else end + 1)
+    offsets.append(size)
+    return offsets
+
+
+def markLines(path, marks):
+    '''Comment out the reported lines of try.rs.'''
+    # Left untouched when there's nothing to mark, so that its mtime doesn't
+    # trigger a rebuild
+    if not marks:
+        return
+    # An empty file can't be mapped, and has no lines to mark anyway
+    if os.path.getsize(path) == 0:
+        for pos in sorted(marks):
+            print('line %d is past the end of try.rs' % (pos + 1))
+        return
+    # Only the reported lines are looked for, without splitting the whole
+    # file into lines
+    starts = []
+    with open(path, 'rb') as helpers_file, \
+         mmap.mmap(helpers_file.fileno(), 0, access=mmap.ACCESS_READ) as scode:
+        start = 0
+        line = 0
+        for pos in sorted(marks):
+            while line < pos:
+                start = scode.find(b'\n', start) + 1 or len(scode)
+                line += 1
+            if start == len(scode):
+                print('line %d is past the end of try.rs' % (pos + 1))
+                continue
+            starts.append(start)
+        if not starts:
+            return
+        # The code in between is copied straight from the mapping into the
+        # output, which is allocated once
+        output = bytearray(len(scode) + len(MARK) * len(starts))
+        with memoryview(scode) as source:
+            prev = 0
+            offset = 0
+            for start in starts:
+                end = offset + start - prev
+                output[offset:end] = source[prev:start]
+                offset = end + len(MARK)
+                output[end:offset] = MARK
+                prev = start
+            output[offset:] = source[prev:]
+    with open(path, 'wb') as helpers_file:
+        helpers_file.write(output)
+
+
+def main():
+    size = os.path.getsize('errors.json')
+    processes = min(os.cpu_count() or 1, size // PARALLEL_CHUNK_SIZE)
+    if processes > 1:
+        offsets = splitMessages('errors.json', processes)
+        marks = set()
+        with concurrent.futures.ProcessPoolExecutor(processes) as executor:
+            for chunk_marks in executor.map(collectMarks, itertools.repeat('errors.json'), offsets[:-1], offsets[1:]):
+                marks |= chunk_marks
+    else:
+        marks = collectMarks('errors.json', 0, size)
+    markLines('helpers/try.rs', marks)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,11 @@
 use std::assert;
-use std::cell::RefCell;
+use std::cell::{OnceCell, RefCell};
+use std::ffi::c_void;
 use std::rc::Rc;
 
+use gl::types::{GLenum, GLint, GLsizeiptr, GLuint};
+use rustc_hash::FxHashMap;
+
 pub struct Context {
     pub gl_ctx: Rc<sdl3::video::GLContext>,
 
@@ -9,9 +13,14 @@ pub struct Context {
     //readable: Option<*mut glws::Drawable>,
 
     pub current_user_program: u32,
-    pub current_program: u32,
+    // Program made current by glUseProgram, or None when display lists may
+    // have changed it
+    pub current_program: Option<GLuint>,
     pub current_pipeline: u32,
 
+    // Active texture unit, or 0 when unknown
+    pub active_texture: GLenum,
+
     pub inside_begin_end: bool,
     pub inside_list: bool,
     pub needs_flush: bool,
@@ -20,6 +29,19 @@ pub struct Context {
 
     pub khr_debug: bool,
     pub max_debug_message_length: i32,
+
+    // Implementation limits, queried on first use
+    max_samples: OnceCell<GLint>,
+    max_raster_samples_ext: OnceCell<GLint>,
+
+    // Buffer bindings and sizes seen so far, so that whole buffer mappings
+    // don't have to query the buffer size back
+    bound_buffers: FxHashMap<GLenum, GLuint>,
+    buffer_sizes: FxHashMap<GLuint, GLsizeiptr>,
+
+    // Pointers of the buffers currently mapped, so that unmapping doesn't
+    // have to query them back
+    buffer_mappings: FxHashMap<GLuint, *mut c_void>,
 }
 
 impl Context {
@@ -29,14 +51,20 @@ impl Context {
             //drawable: None, !TODO
             //readable: None, !TODO
             current_user_program: 0,
-            current_program: 0,
+            current_program: Some(0),
             current_pipeline: 0,
+            active_texture: gl::TEXTURE0,
             inside_begin_end: false,
             inside_list: false,
             needs_flush: false,
             used: false,
             khr_debug: false,
             max_debug_message_length: 0,
+            max_samples: OnceCell::new(),
+            max_raster_samples_ext: OnceCell::new(),
+            bound_buffers: FxHashMap::default(),
+            buffer_sizes: FxHashMap::default(),
+            buffer_mappings: FxHashMap::default(),
         }
     }
 
@@ -44,6 +72,112 @@ impl Context {
         Rc::clone(&self.gl_ctx)
     }
 
+    #[inline]
+    pub fn max_samples(&self) -> GLint {
+        *self.max_samples.get_or_init(|| get_integer(gl::MAX_SAMPLES))
+    }
+
+    #[inline]
+    pub fn max_raster_samples_ext(&self) -> GLint {
+        *self.max_raster_samples_ext.get_or_init(|| get_integer(gl::MAX_RASTER_SAMPLES_EXT))
+    }
+
+    #[inline]
+    pub fn bind_buffer(&mut self, target: GLenum, buffer: GLuint) {
+        if buffer == 0 {
+            self.bound_buffers.remove(&target);
+        } else {
+            self.bound_buffers.insert(target, buffer);
+        }
+    }
+
+    /// Program made current by glUseProgram, queried back only when it
+    /// isn't known.
+    #[inline]
+    pub fn current_program(&self) -> GLuint {
+        match self.current_program {
+            Some(program) => program,
+            None => get_integer(gl::CURRENT_PROGRAM) as GLuint,
+        }
+    }
+
+    /// Program whose uniforms are being specified, from the tracked
+    /// glUseProgram/glBindProgramPipeline state.  The current program takes
+    /// precedence over the pipeline's active program.
+    #[inline]
+    pub fn active_program(&self) -> GLuint {
+        let program = self.current_program();
+        if program != 0 || self.current_pipeline == 0 {
+            program
+        } else {
+            let mut program = 0;
+            unsafe { gl::GetProgramPipelineiv(self.current_pipeline, gl::ACTIVE_PROGRAM, &mut program) };
+            program as GLuint
+        }
+    }
+
+    /// Forget the buffer bound to target, for when it changes behind our back
+    /// (e.g. element array buffers are vertex array state).
+    #[inline]
+    pub fn forget_bound_buffer(&mut self, target: GLenum) {
+        self.bound_buffers.remove(&target);
+    }
+
+    pub fn set_bound_buffer_size(&mut self, target: GLenum, size: GLsizeiptr) {
+        if let Some(&buffer) = self.bound_buffers.get(&target) {
+            self.buffer_sizes.insert(buffer, size);
+        } else {
+            // Whichever buffer is really bound, its cached size is now stale
+            self.buffer_sizes.clear();
+        }
+    }
+
+    pub fn set_buffer_size(&mut self, buffer: GLuint, size: GLsizeiptr) {
+        self.buffer_sizes.insert(buffer, size);
+    }
+
+    pub fn delete_buffer(&mut self, buffer: GLuint) {
+        self.buffer_sizes.remove(&buffer);
+        self.buffer_mappings.remove(&buffer);
+        self.bound_buffers.retain(|_, bound| *bound != buffer);
+    }
+
+    pub fn set_bound_buffer_mapping(&mut self, target: GLenum, ptr: *mut c_void) {
+        if let Some(&buffer) = self.bound_buffers.get(&target) {
+            self.buffer_mappings.insert(buffer, ptr);
+        }
+    }
+
+    pub fn set_buffer_mapping(&mut self, buffer: GLuint, ptr: *mut c_void) {
+        self.buffer_mappings.insert(buffer, ptr);
+    }
+
+    #[inline]
+    pub fn take_bound_buffer_mapping(&mut self, target: GLenum) -> Option<*mut c_void> {
+        let buffer = *self.bound_buffers.get(&target)?;
+        self.buffer_mappings.remove(&buffer)
+    }
+
+    #[inline]
+    pub fn take_buffer_mapping(&mut self, buffer: GLuint) -> Option<*mut c_void> {
+        self.buffer_mappings.remove(&buffer)
+    }
+
+    #[inline]
+    pub fn bound_buffer(&self, target: GLenum) -> Option<GLuint> {
+        self.bound_buffers.get(&target).copied()
+    }
+
+    #[inline]
+    pub fn bound_buffer_size(&self, target: GLenum) -> Option<GLsizeiptr> {
+        self.bound_buffers.get(&target).and_then(|buffer| self.buffer_size(*buffer))
+    }
+
+    #[inline]
+    pub fn buffer_size(&self, buffer: GLuint) -> Option<GLsizeiptr> {
+        self.buffer_sizes.get(&buffer).copied()
+    }
+
     pub fn features(&mut self, feature_name: &'static str) -> bool{
         unsafe {
             let extensions = gl::GetString(gl::EXTENSIONS);
@@ -55,3 +189,10 @@ impl Context {
         }
     }
 }
+
+#[cold]
+fn get_integer(pname: GLenum) -> GLint {
+    let mut value = 0;
+    unsafe { gl::GetIntegerv(pname, &mut value) };
+    value
+}
@@ -1,14 +1,9 @@
-use std::{collections::BTreeMap, error::Error, fmt::Display, panic::Location};
+use std::{error::Error, fmt::Display, panic::Location};
 
-use crate::{call::Call, r#try::GlRetracer};
+use crate::{call::Call, r#try::{lookup_callback, GlRetracer}};
 
 pub type Callback = fn(&mut GlRetracer, &mut Call);
 
-struct Entry {
-    name: String,
-    callback: Callback,
-}
-
 #[derive(Debug)]
 pub enum RetracerError {
     NoCallback(&'static Location<'static>),
@@ -32,29 +27,23 @@ impl Display for RetracerError {
 impl Error for RetracerError {}
 
 pub struct Retracer {
-    map: BTreeMap<String, Callback>,
-    callbacks: Vec<Option<Callback>>,
+    // Callbacks by signature id, looked up by function name the first time
+    // each signature is seen: None until then, and Some(None) for signatures
+    // without a callback, so that those aren't looked up again either
+    callbacks: Vec<Option<Option<Callback>>>,
 }
 
 impl Retracer {
     pub fn init() -> Self {
-        Self { map: BTreeMap::new(), callbacks: Vec::new() }
+        Self { callbacks: Vec::new() }
     }
 
     pub fn retrace(&mut self, call: &mut Call) -> Result<(), RetracerError>{
-        let mut callback: Option<Callback> = None;
         let id = call.sig.id;
         if id >= self.callbacks.len() {
             self.callbacks.resize(id + 1, None);
         }
-        else {
-            callback = self.callbacks[id];
-        }
-
-        if callback.is_none() {
-            callback = self.map.get(&call.sig.name).copied();
-            self.callbacks[id] = callback;
-        }
+        let callback = *self.callbacks[id].get_or_insert_with(|| lookup_callback(call.sig.name.as_str()));
         if let Some(callback) = callback {
             callback(call);
             Ok(())
@@ -63,9 +52,4 @@ impl Retracer {
             Err(RetracerError::no_callback())
         }
     }
-
-    fn add_calback(&mut self, entry: Entry) {
-        self.map.insert(entry.name, entry.callback);
-    }
-
 }